@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import vote_store
+import poll_events
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+analytics_cache_dir = os.getenv("ANALYTICS_CACHE_DIR") or os.path.join(cwd, "analytics_cache")
+log_columns = ["id", "poll_id", "user_id", "option_ids", "recorded_at"]
+
+_lock = threading.Lock()
+
+
+def load_vote_log(changed_since=0, until_id=None):
+    import pandas as pd
+
+    return pd.DataFrame.from_records(vote_store.read_vote_log(changed_since, until_id), columns=log_columns)
+
+
+def summarize_polls(log):
+    # option_ids is the JSON list stored by vote_store, "[]" is a retraction
+    log = log.sort_values("id", kind="stable")
+    log = log.assign(retraction=log["option_ids"].str.len() <= 2)
+
+    user_polls = log.groupby(["poll_id", "user_id"], sort=False).agg(
+        answers=("id", "size"),
+        retractions=("retraction", "sum"),
+        first_at=("recorded_at", "min"),
+        last_at=("recorded_at", "max"),
+        option_ids=("option_ids", "last"),
+    ).reset_index()
+    user_polls["voted"] = user_polls["option_ids"].str.len() > 2
+
+    choices = user_polls.loc[user_polls["voted"], ["poll_id", "option_ids"]]
+    choices = choices.assign(option=choices["option_ids"].str.slice(1, -1).str.split(",")).explode("option")
+    option_votes = choices.assign(option=choices["option"].astype("int64")).groupby(["poll_id", "option"]).size().rename("votes").reset_index()
+
+    return user_polls.drop(columns="option_ids"), option_votes
+
+
+def _cache_file(name):
+    return os.path.join(analytics_cache_dir, "{}.parquet".format(name))
+
+
+def _load_cache_state():
+    try:
+        with open(os.path.join(analytics_cache_dir, "state.json")) as infile:
+            return json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_cache(state, frames):
+    os.makedirs(analytics_cache_dir, exist_ok=True)
+    for name, frame in frames.items():
+        frame.to_parquet(_cache_file(name) + ".tmp", index=False)
+        os.replace(_cache_file(name) + ".tmp", _cache_file(name))
+    # The state goes last, a crash in between only makes the next update redo the same polls
+    state_file = os.path.join(analytics_cache_dir, "state.json")
+    with open(state_file + ".tmp", "w") as outfile:
+        json.dump(state, outfile)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def update_cache(full=False):
+    # The summaries are cached per poll. An update reads the vote log history of
+    # only the polls that got new answers since the last update and replaces them.
+    import pandas as pd
+
+    with _lock:
+        state = _load_cache_state()
+        cached = not full and all(os.path.exists(_cache_file(name)) for name in ("user_polls", "option_votes"))
+        last_id = state.get("last_log_id", 0) if cached else 0
+        until_id = vote_store.last_log_id()
+
+        if cached:
+            user_polls, option_votes = pd.read_parquet(_cache_file("user_polls")), pd.read_parquet(_cache_file("option_votes"))
+            if until_id == last_id:
+                return user_polls, option_votes
+
+        new_user_polls, new_option_votes = summarize_polls(load_vote_log(last_id, until_id))
+        logging.info("Updated the analytics of {} polls up to vote log id {}".format(new_user_polls["poll_id"].nunique(), until_id))
+
+        if cached:
+            changed = new_user_polls["poll_id"].unique()
+            user_polls = pd.concat([user_polls[~user_polls["poll_id"].isin(changed)], new_user_polls], ignore_index=True)
+            option_votes = pd.concat([option_votes[~option_votes["poll_id"].isin(changed)], new_option_votes], ignore_index=True)
+        else:
+            user_polls, option_votes = new_user_polls, new_option_votes
+
+        _save_cache({"last_log_id": until_id}, {"user_polls": user_polls, "option_votes": option_votes})
+    return user_polls, option_votes
+
+
+def final_option_votes():
+    import pandas as pd
+
+    rows = [(result["poll_id"], option, votes) for result in vote_store.final_results() for option, votes in enumerate(result["counts"])]
+    return pd.DataFrame(rows, columns=["poll_id", "option", "votes"])
+
+
+def with_final_counts(option_votes):
+    import pandas as pd
+
+    # Closed polls count with telegram's final result kept by reconcile.py
+    final = final_option_votes()
+    return pd.concat([option_votes[~option_votes["poll_id"].isin(final["poll_id"])], final], ignore_index=True)
+
+
+def event_table(events=None):
+    import pandas as pd
+
+    # poll_to_events columns are kayo_event_<n>, which is option n - 1 of the poll
+    events = poll_events.all_events() if events is None else events
+    rows = [
+        (poll_id, int(name.rsplit("_", 1)[1]) - 1, event_id)
+        for poll_id, names in events.items()
+        for name, event_id in names.items()
+        if event_id
+    ]
+    return pd.DataFrame(rows, columns=["poll_id", "option", "event_id"])
+
+
+def win_rates(option_votes, events):
+    table = events.merge(option_votes, on=["poll_id", "option"], how="left").fillna({"votes": 0})
+    top = table.groupby("poll_id")["votes"].transform("max")
+    # Ties count as a win for every option on top, polls nobody voted in have no winner
+    table["won"] = (table["votes"] == top) & (top > 0)
+
+    rates = table.groupby("event_id").agg(polls=("poll_id", "nunique"), wins=("won", "sum"), votes=("votes", "sum"))
+    rates["win_rate"] = rates["wins"] / rates["polls"]
+    return rates.sort_values(["win_rate", "votes"], ascending=False)
+
+
+def participation(user_polls):
+    poll_count = user_polls["poll_id"].nunique()
+    users = user_polls.groupby("user_id").agg(
+        polls_voted=("voted", "sum"),
+        polls_answered=("poll_id", "size"),
+        first_at=("first_at", "min"),
+        last_at=("last_at", "max"),
+    )
+    users["participation"] = users["polls_voted"] / poll_count if poll_count else 0.0
+    return users.sort_values("participation", ascending=False)
+
+
+def turnout(user_polls, freq="D"):
+    import pandas as pd
+
+    polls = user_polls.groupby("poll_id").agg(voters=("voted", "sum"), opened_at=("first_at", "min"))
+    polls["period"] = pd.to_datetime(polls["opened_at"], unit="s").dt.to_period(freq)
+    return polls.groupby("period").agg(polls=("voters", "size"), voters=("voters", "sum"), mean_voters=("voters", "mean"))
+
+
+def retraction_rates(user_polls):
+    polls = user_polls.assign(retracted=user_polls["retractions"] > 0).groupby("poll_id").agg(
+        answers=("answers", "sum"),
+        retractions=("retractions", "sum"),
+        users=("user_id", "size"),
+        retracting_users=("retracted", "sum"),
+    )
+    polls["retraction_rate"] = polls["retractions"] / polls["answers"]
+    polls["user_retraction_rate"] = polls["retracting_users"] / polls["users"]
+    return polls.sort_values("retraction_rate", ascending=False)
+
+
+reports = {
+    "win-rates": lambda user_polls, option_votes, freq: win_rates(with_final_counts(option_votes), event_table()),
+    "participation": lambda user_polls, option_votes, freq: participation(user_polls),
+    "turnout": lambda user_polls, option_votes, freq: turnout(user_polls, freq),
+    "retractions": lambda user_polls, option_votes, freq: retraction_rates(user_polls),
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Poll analytics over the local vote history")
+    parser.add_argument("report", choices=list(reports))
+    parser.add_argument("--full", action="store_true", help="Rebuild the per poll cache from the whole vote log")
+    parser.add_argument("--freq", default="D", help="Period of the turnout report, e.g. D, W or M")
+    parser.add_argument("--limit", type=int, default=20, help="Rows to print")
+    parser.add_argument("--csv", help="Write the full report to this csv file")
+    args = parser.parse_args(argv)
+
+    user_polls, option_votes = update_cache(args.full)
+    report = reports[args.report](user_polls, option_votes, args.freq)
+    if args.csv:
+        report.to_csv(args.csv)
+    print(report.head(args.limit).to_string())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,108 +1,235 @@
 import os
 import logging
-import requests
-import ipaddress
-import pandas as pd
-from flask import Flask, request
+import threading
+import log_setup
+import dedup
+import metrics
+import ip_allowlist
+import http_client
+import page_cache
+import poll_events
+import ingest_queue
+import result_coalescer
+import vote_writer
+import vote_store
+from notion_payloads import poll_det_result_dbid, get_page_id, get_poll_result_properties, get_user_vote_properties, find_user_page_id
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from datetime import datetime, timezone
 
 load_dotenv()
 cwd = os.getenv("PROJECT_DIR")
 
-logging.basicConfig(filename='{}/app.log'.format(cwd), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+log_setup.setup()
 
 app = Flask(__name__)
 
 bot_token = os.getenv("API_KEY")
 chat_id = os.getenv("CHANNEL_ID")
-poll_result_dbid = os.getenv("POLL_RESULT_DB_ID")
-poll_det_result_dbid = os.getenv("POLL_DET_RESULT_DB_ID")
 
-notion_headers = {
-    "Authorization": "Bearer " + os.getenv("NOTION_TOKEN"),
-    "Content-Type": "application/json",
-    "Notion-Version": "2022-06-28"
-}
+poll_events.load()
 
+_start_lock = threading.Lock()
+_started = False
 
-telegram_ip_ranges = ['149.154.160.0/20', '91.108.4.0/22']
 
-def is_telegram_request(remote_addr):
-    logging.info(remote_addr)
-    try:
-        for ip_range in telegram_ip_ranges:
-            if ipaddress.ip_address(remote_addr) in ipaddress.ip_network(ip_range):
-                return True
-    except Exception as e:
-        logging.error("Unable to validate the source of the request. Error - {}".format(e))
-        return False
-    return False
+def is_telegram_request(remote_addr, forwarded_for=""):
+    return ip_allowlist.is_allowed(remote_addr, forwarded_for)
 
 
 @app.route('/', methods=['POST'])
 def handle_update():
-    logging.info("Request from the source - {} has came to handle update method. Checking if the request came from telegram....".format(request.remote_addr or request.headers.get("X-Forwarded-For", "")))
-    if request.method == 'POST' and is_telegram_request(request.remote_addr or request.headers.get("X-Forwarded-For", "")):
+    with metrics.profile_request("webhook"), metrics.stage("webhook"):
+        return _handle_update()
+
+
+def _handle_update():
+    with metrics.stage("ip_check"):
+        allowed = is_telegram_request(request.remote_addr, request.headers.get("X-Forwarded-For", ""))
+    if request.method == 'POST' and allowed:
+        token = None
         try:
             data = request.get_json()
-            logging.info("Received the update - {}. Checking if the data contains results...".format(data))
-
-            # If update is for result count
-            if "poll" in data and "total_voter_count" in data["poll"]:
-                logging.info("Calling method to update latest results...")
-                update_poll_results(data)
-
-            elif "poll_answer" in data and "option_ids" in data["poll_answer"]:
-                if len(data["poll_answer"]["option_ids"]) > 0:
-                    logging.info("Calling method to insert the user's answer")
-                    insert_user_vote(data)
-                else:
-                    logging.info("User retracted his vote. Calling method to delete the vote.")
-                    remove_user_vote(data)
-
-            return 'ok'
+            token = log_setup.set_request_id(data.get("update_id"))
+            logging.info("Received the update - %s. Checking if the data contains results...", log_setup.payload(data))
+            return accept_update(data)
         except Exception as e:
-            logging.error("Unable to process the incoming request. Error - {}".format(e))
+            logging.error("Unable to process the incoming request. Error - %s", e)
             return 'Not Ok'
+        finally:
+            if token is not None:
+                log_setup.reset_request_id(token)
     else:
-        logging.info("Invalid request method or source.")
+        logging.info("Invalid request method or source - %s.", request.remote_addr)
+        metrics.inc("pollbot_updates_total", type="rejected")
         return 'Invalid request', 400
 
 
-def get_page_id(poll_result):
-    url = "https://api.notion.com/v1/databases/{}/query".format(poll_result_dbid)
-    
-    poll_id = poll_result["poll"]["id"]
-    data = {
-        "filter": {
-            "property": "Poll ID",
-            "title": {
-                "contains": poll_id
-            }
-        }
-    }
+def accept_update(data):
+    # Takes an update in for the background workers, shared with asgi_app.py.
+    # Returns the response body and status for telegram.
+    key = get_update_key(data)
+    if key is None:
+        logging.info("Update does not contain a poll or poll answer. Ignoring it.")
+        metrics.inc("pollbot_updates_total", type="ignored")
+        return 'ok', 200
+
+    with metrics.stage("dedup"):
+        seen = dedup.accept(data)
+    if seen is None:
+        logging.info("Update %s was already received. Dropping the replay.", data.get("update_id"))
+        metrics.inc("pollbot_updates_total", type="duplicate")
+        return 'ok', 200
+
+    start_background_workers()
+    with metrics.stage("enqueue"):
+        queued = ingest_queue.enqueue(data, key)
+    if not queued:
+        # Telegram sends it again, which must not count as a replay
+        dedup.release(seen)
+        metrics.inc("pollbot_updates_total", type="queue_full")
+        logging.error("Ingestion queue is full. Asking telegram to retry the update later.")
+        return 'Queue is full', 503
+
+    return 'ok', 200
+
+
+def is_local_request():
+    # The operational endpoints are only for the host itself
+    return metrics.is_local(request.remote_addr, request.headers.get("X-Forwarded-For", ""))
+
+
+@app.route('/queue', methods=['GET'])
+def queue_depth():
+    if not is_local_request():
+        return 'Invalid request', 403
+    return jsonify(ingest_queue.queue_stats())
+
+
+@app.route('/http-metrics', methods=['GET'])
+def http_metrics():
+    if not is_local_request():
+        return 'Invalid request', 403
+    return jsonify(http_client.get_metrics())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not is_local_request():
+        return 'Invalid request', 403
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/profiling', methods=['GET', 'POST'])
+def profiling():
+    if not is_local_request():
+        return 'Invalid request', 403
+    # Only a POST switches it, a GET just shows the state
+    if request.method == "POST" and "enabled" in request.args:
+        metrics.set_profiling(request.args["enabled"] in ("1", "true", "on"))
+    return jsonify({"enabled": metrics.profiling_enabled(), "slow_seconds": metrics.profile_slow_seconds})
+
+
+@app.route('/tallies/<poll_id>', methods=['GET'])
+def poll_tallies(poll_id):
+    # A closed poll answers from its final snapshot
+    final = vote_store.get_final_result(poll_id)
+    if final is not None:
+        return jsonify({option_id: voter_count for option_id, voter_count in enumerate(final["counts"])})
+    return jsonify(vote_store.get_tallies(poll_id))
+
+
+def start_background_workers():
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    result_coalescer.start(update_poll_results)
+    vote_writer.start(poll_det_result_dbid, find_user_page_id, vote_store.mark_synced)
+    resync_votes()
+    ingest_queue.start_workers(process_update)
+
+
+def stop_background_workers():
+    global _started
+    with _start_lock:
+        if not _started:
+            return
+        _started = False
+
+    ingest_queue.stop_workers()
+    result_coalescer.stop()
+    vote_writer.stop()
+
+
+def resync_votes():
+    # Votes recorded locally whose notion write never went through (e.g. the app stopped mid batch)
+    unsynced = vote_store.unsynced_votes()
+    if unsynced:
+        logging.info("Re-sending %s votes that are not in notion yet.", len(unsynced))
+
+    for poll_id, user, option_ids, version in unsynced:
+        if option_ids:
+            poll_data = {"poll_answer": {"poll_id": poll_id, "user": user, "option_ids": option_ids}}
+            try:
+                properties = get_user_vote_properties(poll_data)
+            except ValueError as e:
+                logging.error("Unable to re-send the vote of user %s. Error - %s", user["id"], e)
+                continue
+            # The page may exist already if only the sync mark was lost, rewrite it instead of adding a second one
+            replace_existing = page_cache.get_vote_page(poll_id, user["id"]) is not None
+            vote_writer.submit_vote(poll_id, user["id"], properties, version, replace_existing)
+        else:
+            vote_writer.submit_retraction(poll_id, user["id"], version)
 
-    try:
-        logging.info("Making the api call to find the entry that corresponds to the poll - {}".format(poll_id))
-        resp = requests.post(url, json=data, headers=notion_headers)
-        resp_json = resp.json()
-        logging.info("Response from query database to get required page - {}".format(resp_json))
-        
-        if resp.status_code == 200:
-            if len(resp_json["results"]) > 1:
-                logging.error("Duplicate entries found in poll result db for poll id - {}.".format(poll_id))
-                return {"Status": "Failure"}
-            elif len(resp_json["results"]) == 0:
-                logging.error("No entry found for the required poll - {}".format(poll_id))
-                return {"Status": "Failure"}
-            else:
-                page_id = resp_json["results"][0]["id"]
-    except Exception as e:
-        logging.error("Unable to process the poll result to get correspdoning notion page ID. Error - {}".format(e))
-        return {"Status": "Failure"}
 
-    return {"Status": "Success", "page_id": page_id}
+def get_update_key(data):
+    if "poll" in data and "total_voter_count" in data["poll"]:
+        return data["poll"]["id"]
+    elif "poll_answer" in data and "option_ids" in data["poll_answer"]:
+        return "{}:{}".format(data["poll_answer"]["poll_id"], data["poll_answer"]["user"]["id"])
+    return None
+
+
+def process_update(data):
+    token = log_setup.set_request_id(data.get("update_id"))
+    try:
+        with metrics.profile_request("process_update"), metrics.stage("process_update"):
+            _process_update(data)
+    finally:
+        log_setup.reset_request_id(token)
+
+
+def _process_update(data):
+    # If update is for result count
+    if "poll" in data and "total_voter_count" in data["poll"]:
+        logging.info("Passing the latest results to the coalescer...")
+        metrics.inc("pollbot_updates_total", type="result")
+        if data["poll"]["is_closed"]:
+            # Kept for the reconcile when the stop did not return the final poll
+            vote_store.save_closed_poll(data["poll"])
+        result_coalescer.submit(data)
+
+    elif "poll_answer" in data and "option_ids" in data["poll_answer"]:
+        poll_answer = data["poll_answer"]
+        # Built first, an unknown poll must fail before the vote is recorded
+        properties = get_user_vote_properties(data) if poll_answer["option_ids"] else None
+        with metrics.stage("record_vote"):
+            previous, version = vote_store.record_vote(poll_answer["poll_id"], poll_answer["user"], poll_answer["option_ids"], data.get("update_id"))
+
+        if len(poll_answer["option_ids"]) > 0:
+            logging.info("Calling method to insert the user's answer")
+            metrics.inc("pollbot_updates_total", type="vote")
+            insert_user_vote(data, version, properties)
+        elif previous == []:
+            logging.info("User has no vote left to retract in this poll. Nothing to remove.")
+            metrics.inc("pollbot_updates_total", type="retraction_noop")
+            vote_store.mark_synced(poll_answer["poll_id"], poll_answer["user"]["id"], version)
+        else:
+            logging.info("User retracted his vote. Calling method to delete the vote.")
+            metrics.inc("pollbot_updates_total", type="retraction")
+            remove_user_vote(data, version)
 
 
 def update_poll_results(poll_result):
@@ -113,131 +240,39 @@ def update_poll_results(poll_result):
         return "Not Ok"
     try:
         page_id = resp["page_id"]
-        url = "https://api.notion.com/v1/pages/{}".format(page_id)
-
-        location_1_votes = poll_result["poll"]["options"][0]["voter_count"]
-        location_2_votes = poll_result["poll"]["options"][1]["voter_count"]
-        location_3_votes = poll_result["poll"]["options"][2]["voter_count"]
-        status = "Closed" if poll_result["poll"]["is_closed"] else "Open"
-
-        data = {
-            "Kayo Event 1": {"number": location_1_votes},
-            "Kayo Event 2": {"number": location_2_votes},
-            "Kayo Event 3": {"number": location_3_votes},
-            "Status": {"select": {"name": status}}
-        }
-
-        payload = {"properties": data}
-        resp = requests.patch(url, json=payload, headers=notion_headers)
-        logging.info("Response from update entry api call - {}".format(resp.json()))
+        path = "/pages/{}".format(page_id)
+        payload = {"properties": get_poll_result_properties(poll_result)}
+        with metrics.stage("notion_write"):
+            resp = http_client.notion_request("PATCH", path, json=payload)
+        logging.info("Response from update entry api call - %s", log_setup.payload(resp.json))
+
+        if poll_result["poll"]["is_closed"] or resp.status_code == 404:
+            page_cache.evict_poll(poll_result["poll"]["id"])
     except Exception as e:
-        logging.error("Unable to update poll results in db. Error - {}".format(e))
+        logging.error("Unable to update poll results in db. Error - %s", e)
+        return "Not Ok"
 
+    if resp.status_code != 200:
+        logging.error("Update of the results of poll %s failed with status %s.", poll_result["poll"]["id"], resp.status_code)
+        return "Not Ok"
     return resp
 
-def insert_user_vote(poll_data):
-    url = "https://api.notion.com/v1/pages"
-
+def insert_user_vote(poll_data, version=None, properties=None):
     poll_id = poll_data["poll_answer"]["poll_id"]
-    poll_date = datetime.now().astimezone(timezone.utc).today().date().isoformat()
     userid = poll_data["poll_answer"]["user"]["id"]
-    username = poll_data["poll_answer"]["user"].get("username", "")
-    first_name = poll_data["poll_answer"]["user"].get("first_name", "")
-    last_name = poll_data["poll_answer"]["user"].get("last_name", "")
-    option_id_choice = poll_data["poll_answer"]["option_ids"][0]
-
-    event_name = os.getenv("EVENT_NAME")
-    poll_to_event_df = pd.read_csv(os.path.join(cwd, "poll_to_events.csv"), dtype=str).set_index("poll_id")
-    user_selection =  poll_to_event_df.loc[poll_id, "{}{}".format(event_name, option_id_choice + 1)]
-
-    data = {
-        "Poll ID": {"title": [{"text": {"content": poll_id}}]},
-        "Date": {"date": {"start": poll_date, "end": None}},
-        "UserID": {"number": userid},
-        "Username": {"rich_text": [{"text": {"content": username}}]},
-        "First Name": {"rich_text": [{"text": {"content": first_name}}]},
-        "Last Name": {"rich_text": [{"text": {"content": last_name}}]},
-        "Choice": {"rich_text": [{"text": {"content": user_selection}}]},
-    }
-
-    payload = {
-        "parent": {
-            "database_id": poll_det_result_dbid
-            },
-            "properties": data
-    }
+    data = properties or get_user_vote_properties(poll_data)
 
-    try:
-        response = requests.post(url, json=payload, headers=notion_headers)
-        logging.info("Response from insert user vote api call - {}".format(response.json()))
-    except Exception as e:
-        logging.error("Unable to insert the user vote in detailed poll result DB. Error - {}".format(e))
-        {"Status": "Failure"}
+    logging.info("Adding the vote of user - %s for poll - %s to the next batch.", userid, poll_id)
+    vote_writer.submit_vote(poll_id, userid, data, version)
     return {"Status": "Success"}
 
 
-def get_user_page_id(poll_result):
-    url = "https://api.notion.com/v1/databases/{}/query".format(poll_det_result_dbid)
-    
-    user_id = poll_result["poll_answer"]["user"]["id"]
-    poll_id = poll_result["poll_answer"]["poll_id"]
-
-    data = {
-        "filter":{
-        "and" : [{
-            "property": "UserID",
-            "number": {
-                "equals": user_id
-            }
-        },
-        {
-            "property": "Poll ID",
-            "title": {
-                "contains": poll_id
-            }
-        }]}
-    }
-
-    try:
-        logging.info("Making the api call to find the entry that correspondsing to the user - {} vote for poll - {}".format(user_id, poll_id))
-        resp = requests.post(url, json=data, headers=notion_headers)
-        resp_json = resp.json()
-        logging.info("Response from query database to get required page - {}".format(resp_json))
-        
-        if resp.status_code == 200:
-            if len(resp_json["results"]) > 1:
-                logging.error("Duplicate entries found in poll result db for poll id - {}.".format(poll_id))
-                return {"Status": "Failure"}
-            elif len(resp_json["results"]) == 0:
-                logging.error("No entry found for the required poll - {}".format(poll_id))
-                return {"Status": "Failure"}
-            else:
-                page_id = resp_json["results"][0]["id"]
-        else:
-            return {"Status": "Failure"}
-    except Exception as e:
-        logging.error("Unable to find the page id of the user entry in db for user - {}. Error - {}".format(user_id, e))
-        return {"Status": "Failure"}
-
-    return {"Status": "Success", "page_id": page_id}
-
-def remove_user_vote(poll_user_data):
-    resp = get_user_page_id(poll_user_data)
+def remove_user_vote(poll_user_data, version=None):
+    poll_id = poll_user_data["poll_answer"]["poll_id"]
+    user_id = poll_user_data["poll_answer"]["user"]["id"]
 
-    if resp["Status"] != "Success":
-        logging.error("Not able to find the corresponding entry for user vote for the poll. Exiting....")
-        return "Not Ok"
-
-    page_id = resp["page_id"]
-    url = "https://api.notion.com/v1/pages/{}".format(page_id)
-    payload = {"archived": True}
-
-    try:
-        resp = requests.patch(url, json=payload, headers=notion_headers)
-        logging.info("Response from remove user entry api call since user has retracted the vote - {}".format(resp.json()))
-    except Exception as e:
-        logging.error("Unable to remove user vote entry. Error - {}".format(e))
-        return "Not Ok"
+    logging.info("Adding the retraction of user - %s for poll - %s to the next batch.", user_id, poll_id)
+    vote_writer.submit_retraction(poll_id, user_id, version)
     return "Ok"
 
 if __name__ == "__main__":
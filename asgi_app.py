@@ -0,0 +1,102 @@
+import os
+import json
+import anyio
+import asyncio
+import logging
+import log_setup
+import metrics
+import http_client
+from app import is_telegram_request, accept_update, start_background_workers, stop_background_workers
+from dotenv import load_dotenv
+
+load_dotenv()
+
+max_in_flight = int(os.getenv("ASGI_MAX_IN_FLIGHT", "2000"))
+
+# The webhook only takes the update in and answers telegram. The updates are
+# applied by the same ingestion queue, vote writer and result coalescer as in
+# app.py, which run in threads. Their sqlite calls are kept off the event loop.
+_in_flight = None
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def _respond(send, status, body, content_type=b"text/plain"):
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    global _in_flight
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _in_flight = asyncio.Semaphore(max_in_flight)
+            # Also re-sends the votes that are not in notion yet
+            await anyio.to_thread.run_sync(start_background_workers)
+            logging.info("Async webhook server started.")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await anyio.to_thread.run_sync(stop_background_workers)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    global _in_flight
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    if scope["type"] != "http":
+        return
+
+    headers = dict(scope.get("headers") or [])
+    remote_addr = (scope.get("client") or ("", 0))[0]
+    forwarded_for = headers.get(b"x-forwarded-for", b"").decode("latin-1")
+
+    if scope["method"] == "GET" and scope["path"] in ("/metrics", "/http-metrics"):
+        if not metrics.is_local(remote_addr, forwarded_for):
+            return await _respond(send, 403, "Invalid request")
+        if scope["path"] == "/http-metrics":
+            return await _respond(send, 200, json.dumps(http_client.get_metrics()), b"application/json")
+        return await _respond(send, 200, metrics.render(), b"text/plain; version=0.0.4")
+
+    with metrics.stage("ip_check"):
+        allowed = is_telegram_request(remote_addr, forwarded_for)
+    if scope["method"] != "POST" or scope["path"] != "/" or not allowed:
+        logging.info("Invalid request method or source - %s.", remote_addr)
+        metrics.inc("pollbot_updates_total", type="rejected")
+        return await _respond(send, 400, "Invalid request")
+
+    if _in_flight is None:
+        _in_flight = asyncio.Semaphore(max_in_flight)
+    if _in_flight.locked():
+        logging.error("Too many updates in flight. Asking telegram to retry the update later.")
+        metrics.inc("pollbot_updates_total", type="queue_full")
+        return await _respond(send, 503, "Too many requests in flight")
+
+    async with _in_flight:
+        try:
+            data = json.loads(await _read_body(receive))
+            log_setup.set_request_id(data.get("update_id"))
+            logging.info("Received the update - %s. Checking if the data contains results...", log_setup.payload(data))
+            with metrics.stage("webhook"):
+                body, status = await anyio.to_thread.run_sync(accept_update, data)
+        except Exception as e:
+            logging.error("Unable to process the incoming request. Error - %s", e)
+            return await _respond(send, 200, "Not Ok")
+    return await _respond(send, status, body)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi_app:app", host="0.0.0.0", port=int(os.getenv("ASGI_PORT", "8000")))
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Builds a synthetic vote history and times the full analytics build, an
+# incremental update after one more poll and each report on the cached data.
+def generate_history(db_file, votes, polls, users, options, retraction_share, seed, start_id=0):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    poll_index = rng.integers(0, polls, votes)
+    user_ids = rng.integers(1, users + 1, votes)
+    choices = rng.integers(0, options, votes)
+    retracted = rng.random(votes) < retraction_share
+    recorded_at = 1672531200 + poll_index * 86400 + rng.integers(0, 86400, votes)
+
+    option_ids = np.where(retracted, "[]", np.char.add(np.char.add("[", choices.astype(str)), "]"))
+    rows = zip(
+        range(start_id + 1, start_id + votes + 1),
+        ("poll-{}".format(i) for i in poll_index.tolist()),
+        user_ids.tolist(),
+        option_ids.tolist(),
+        recorded_at.tolist(),
+    )
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.executemany("INSERT INTO vote_log (id, poll_id, user_id, option_ids, recorded_at) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.close()
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print("{:<28} {:>8.3f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark analytics.py on a synthetic vote history")
+    parser.add_argument("--votes", type=int, default=2000000)
+    parser.add_argument("--polls", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--options", type=int, default=3)
+    parser.add_argument("--retractions", type=float, default=0.05, help="Share of answers that are retractions")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_analytics_")
+    os.environ["VOTE_STORE_DB"] = os.path.join(workdir, "votes.db")
+    os.environ["ANALYTICS_CACHE_DIR"] = os.path.join(workdir, "analytics_cache")
+
+    import analytics
+    import vote_store
+
+    vote_store.last_log_id()
+    timed("generate {} votes".format(args.votes), lambda: generate_history(
+        os.environ["VOTE_STORE_DB"], args.votes, args.polls, args.users, args.options, args.retractions, args.seed
+    ))
+
+    events = {"poll-{}".format(i): {"kayo_event_{}".format(n + 1): "event-{}".format((i * args.options + n) % 500) for n in range(args.options)} for i in range(args.polls + 1)}
+    event_table = analytics.event_table(events)
+
+    timed("load vote log", lambda: analytics.load_vote_log())
+    user_polls, option_votes = timed("full cache build", lambda: analytics.update_cache(full=True))
+    timed("cached, no new votes", lambda: analytics.update_cache())
+
+    new_votes = max(1, args.votes // args.polls)
+    generate_history(os.environ["VOTE_STORE_DB"], new_votes, 1, args.users, args.options, args.retractions, args.seed + 1, start_id=vote_store.last_log_id())
+    # The generated poll is poll-0, so the incremental update re-reads one poll's history
+    user_polls, option_votes = timed("incremental (+{} votes)".format(new_votes), lambda: analytics.update_cache())
+
+    timed("win rates", lambda: analytics.win_rates(option_votes, event_table))
+    timed("participation", lambda: analytics.participation(user_polls))
+    timed("turnout", lambda: analytics.turnout(user_polls))
+    timed("retraction rates", lambda: analytics.retraction_rates(user_polls))
+    print("workdir {}".format(workdir))
+
+
+if __name__ == "__main__":
+    main()
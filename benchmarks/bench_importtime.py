@@ -0,0 +1,59 @@
+import os
+import sys
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+entry_points = ["cli", "stop_poll", "send_poll", "scheduler", "app", "asgi_app"]
+# None of these should be loaded just by starting an entry point
+heavy_modules = ["pandas", "numpy", "pyarrow", "grpc", "google.cloud.vision", "cv2", "pytesseract", "httpx", "asyncio"]
+
+
+# Cold start cost of each entry point from `python -X importtime`. Every run is
+# a fresh interpreter, the median of the runs is reported with the modules that
+# took longest and any heavy dependency that got imported on the way.
+def import_times(module):
+    code = "import sys, {}; print(','.join(m for m in {!r} if m in sys.modules))".format(module, heavy_modules)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the entry points")
+    parser.add_argument("modules", nargs="*", default=entry_points)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="Slowest imports to show per entry point")
+    args = parser.parse_args()
+
+    print("{:<12} {:>10}  {}".format("entry point", "median ms", "heavy modules loaded"))
+    for module in args.modules:
+        runs = []
+        try:
+            for _ in range(args.runs):
+                runs.append(import_times(module))
+        except RuntimeError as e:
+            print("{:<12} failed - {}".format(module, e))
+            continue
+
+        totals = sorted(times.get(module, 0) for times, _ in runs)
+        times, loaded = runs[len(runs) // 2]
+        print("{:<12} {:>10.1f}  {}".format(module, totals[len(totals) // 2] / 1000, ", ".join(loaded) or "-"))
+        slowest = sorted(((t, name) for name, t in times.items() if name != module and "." not in name), reverse=True)[:args.top]
+        for t, name in slowest:
+            print("{:<14} {:>8.1f}  {}".format("", t / 1000, name))
+
+
+if __name__ == "__main__":
+    main()
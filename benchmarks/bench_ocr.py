@@ -0,0 +1,67 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ocr
+
+
+# Compares the OCR backends on latency and on how many of the expected location
+# ids each one finds. Expected ids come from a JSON file mapping image file name
+# to the list of ids; without it the Vision result is used as the reference.
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OCR backends used by send_poll.process_img")
+    parser.add_argument("images", nargs="+", help="Image files to run the backends on")
+    parser.add_argument("--pattern", default=os.getenv("PATTERN"), help="Regex of a location id (defaults to PATTERN)")
+    parser.add_argument("--expected", help="JSON file mapping image file name to the expected location ids")
+    parser.add_argument("--backends", default="vision,tesseract", help="Comma separated backends to compare")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per image and backend")
+    args = parser.parse_args()
+
+    expected = {}
+    if args.expected:
+        with open(args.expected) as infile:
+            expected = json.load(infile)
+
+    backends = args.backends.split(",")
+    print("{:<30} {:<10} {:>12} {:>10} {:>10}".format("image", "backend", "latency (s)", "found", "accuracy"))
+    totals = {backend: {"seconds": 0.0, "hits": 0, "expected": 0} for backend in backends}
+
+    for image in args.images:
+        with open(image, "rb") as infile:
+            content = infile.read()
+
+        found, latency = {}, {}
+        for backend in backends:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                try:
+                    found[backend] = ocr.extract_location_ids(content, args.pattern, backend, use_cache=False)
+                except Exception as e:
+                    print("{:<30} {:<10} failed - {}".format(os.path.basename(image), backend, e))
+                    found[backend] = None
+                    break
+            latency[backend] = (time.perf_counter() - start) / args.repeat
+            totals[backend]["seconds"] += latency[backend]
+
+        reference = expected.get(os.path.basename(image), found.get("vision") or [])
+        for backend in backends:
+            if found[backend] is None:
+                continue
+            hits = len(set(found[backend]) & set(reference))
+            totals[backend]["hits"] += hits
+            totals[backend]["expected"] += len(reference)
+            accuracy = hits / len(reference) if reference else 0.0
+            print("{:<30} {:<10} {:>12.3f} {:>10} {:>10.2%}".format(os.path.basename(image), backend, latency[backend], len(found[backend]), accuracy))
+
+    print()
+    for backend, total in totals.items():
+        accuracy = total["hits"] / total["expected"] if total["expected"] else 0.0
+        print("{:<10} mean latency {:.3f}s, accuracy {:.2%}".format(backend, total["seconds"] / len(args.images), accuracy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock_server
+
+results_db_id = "mock-poll-results"
+votes_db_id = "mock-poll-votes"
+
+
+# Fires a stream of poll and poll_answer updates at app.handle_update from a
+# Telegram address, with Notion and Telegram replaced by mock_server. Reports
+# webhook throughput and latency, how long the background writers take to
+# drain, and how many Notion calls each vote cost.
+def generate_updates(polls, votes, users, options, retraction_share, result_every, seed):
+    rng = random.Random(seed)
+    current = {}
+    counts = {"poll-{}".format(p): [0] * options for p in range(polls)}
+    updates = []
+    update_id = 1000
+
+    for n in range(votes):
+        poll_id = "poll-{}".format(rng.randrange(polls))
+        user_id = rng.randint(1, users)
+        previous = current.get((poll_id, user_id))
+        if previous is not None and rng.random() < retraction_share:
+            option_ids = []
+        else:
+            option_ids = [rng.randrange(options)]
+
+        for option in previous or []:
+            counts[poll_id][option] -= 1
+        for option in option_ids:
+            counts[poll_id][option] += 1
+        current[(poll_id, user_id)] = option_ids
+
+        update_id += 1
+        updates.append({"update_id": update_id, "poll_answer": {
+            "poll_id": poll_id, "user": {"id": user_id, "is_bot": False, "first_name": "user{}".format(user_id)}, "option_ids": option_ids
+        }})
+
+        if result_every and (n + 1) % result_every == 0:
+            update_id += 1
+            updates.append({"update_id": update_id, "poll": {
+                "id": poll_id, "question": "Where to?", "is_closed": False, "total_voter_count": sum(counts[poll_id]),
+                "options": [{"text": "Option {}".format(i + 1), "voter_count": count} for i, count in enumerate(counts[poll_id])]
+            }})
+    return updates
+
+
+def update_key(update):
+    if "poll" in update:
+        return update["poll"]["id"]
+    answer = update["poll_answer"]
+    return "{}:{}".format(answer["poll_id"], answer["user"]["id"])
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the webhook against a mock Notion and Telegram")
+    parser.add_argument("--polls", type=int, default=5)
+    parser.add_argument("--votes", type=int, default=2000, help="poll_answer updates to send")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--options", type=int, default=3)
+    parser.add_argument("--retraction-share", type=float, default=0.1, help="Share of answers by users who voted before that retract")
+    parser.add_argument("--result-every", type=int, default=5, help="Send a poll result update after every this many answers")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent webhook callers")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock adds to every api call")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--rate-limit-share", type=float, default=0.0, help="Share of api calls the mock answers with 429")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--notion-rate", type=float, default=None, help="Override NOTION_RATE_LIMIT for the run")
+    parser.add_argument("--source-ip", default="149.154.167.220", help="Address the updates come from")
+    parser.add_argument("--long-poll", action="store_true", help="Feed the updates to long_poll.py through getUpdates instead of posting them to the webhook")
+    parser.add_argument("--replay", help="JSONL file of updates to send instead of a generated stream")
+    parser.add_argument("--record", help="Write the generated stream to this JSONL file")
+    parser.add_argument("--drain-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    server, mock = mock_server.start(latency=args.latency, jitter=args.jitter, rate_limit_share=args.rate_limit_share, retry_after=args.retry_after, seed=args.seed)
+    base_url = "http://127.0.0.1:{}".format(server.server_port)
+
+    # Everything the app keeps on disk goes to a scratch directory
+    workdir = tempfile.mkdtemp(prefix="load_test_")
+    os.environ.update({
+        "PROJECT_DIR": workdir,
+        "LOG_DIR": workdir,
+        "NOTION_API_URL": base_url + "/v1",
+        "TELEGRAM_API_URL": base_url,
+        "NOTION_TOKEN": "mock",
+        "POLL_RESULT_DB_ID": results_db_id,
+        "POLL_DET_RESULT_DB_ID": votes_db_id,
+        "EVENT_NAME": "kayo_event_",
+        "LOCATIONS_COUNT": str(args.options),
+        "LONG_POLL_TIMEOUT": "1",
+    })
+    if args.notion_rate is not None:
+        os.environ["NOTION_RATE_LIMIT"] = str(args.notion_rate)
+        os.environ["NOTION_BURST"] = str(max(1, int(args.notion_rate)))
+
+    if args.replay:
+        with open(args.replay) as infile:
+            updates = [json.loads(line) for line in infile if line.strip()]
+    else:
+        updates = generate_updates(args.polls, args.votes, args.users, args.options, args.retraction_share, args.result_every, args.seed)
+    if args.record:
+        with open(args.record, "w") as outfile:
+            outfile.writelines(json.dumps(update) + "\n" for update in updates)
+
+    import app
+    import poll_events
+    import ingest_queue
+    import vote_writer
+    import result_coalescer
+
+    # What send_poll.py would have registered for each poll
+    poll_ids = sorted({update["poll"]["id"] if "poll" in update else update["poll_answer"]["poll_id"] for update in updates})
+    poll_events.add_polls([(poll_id, ["{}-event-{}".format(poll_id, i + 1) for i in range(args.options)]) for poll_id in poll_ids])
+    for poll_id in poll_ids:
+        page = {"id": "{:032x}".format(zlib.crc32(poll_id.encode())), "parent": {"database_id": results_db_id}, "archived": False,
+                "properties": {"Poll ID": {"title": [{"text": {"content": poll_id}}]}}}
+        mock.pages[page["id"]] = page
+
+    answers = sum(1 for update in updates if "poll_answer" in update)
+    # Updates of one poll or one user go through the same caller, so they keep their order like they do from telegram
+    lanes = [[] for _ in range(args.concurrency)]
+    for update in updates:
+        lanes[zlib.crc32(update_key(update).encode()) % args.concurrency].append(update)
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def run_lane(lane):
+        client = app.app.test_client()
+        local_latencies, local_statuses = [], {}
+        for update in lane:
+            start = time.perf_counter()
+            response = client.post("/", json=update, environ_base={"REMOTE_ADDR": args.source_ip})
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[response.status_code] = local_statuses.get(response.status_code, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    def run_long_poll():
+        import long_poll
+
+        mock.add_updates(updates)
+        poller = threading.Thread(target=long_poll.run_forever, name="long-poll", daemon=True)
+        poller.start()
+        while poller.is_alive() and (long_poll.load_offset() or 0) <= updates[-1]["update_id"]:
+            time.sleep(0.01)
+        long_poll.stop()
+        poller.join()
+
+    mock.reset_stats()
+    start = time.perf_counter()
+    if args.long_poll:
+        print("Serving {} updates ({} answers, {} polls) through getUpdates...".format(len(updates), answers, len(poll_ids)))
+        run_long_poll()
+    else:
+        print("Sending {} updates ({} answers, {} polls) with {} callers...".format(len(updates), answers, len(poll_ids), args.concurrency))
+        threads = [threading.Thread(target=run_lane, args=(lane,)) for lane in lanes if lane]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    sent_seconds = time.perf_counter() - start
+
+    # The webhook only queues the updates, the notion writes happen in the background
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline:
+        if ingest_queue.queue_stats()["depth"] == 0 and vote_writer.pending_count() == 0 and result_coalescer.pending_count() == 0:
+            break
+        time.sleep(0.05)
+    result_coalescer.flush_all()
+    vote_writer.flush_all()
+    drained_seconds = time.perf_counter() - start
+
+    stats = mock.stats()
+    notion_calls = sum(count for endpoint, count in stats["calls"].items() if endpoint.startswith("notion"))
+    queue = ingest_queue.queue_stats()
+
+    print()
+    if not args.long_poll:
+        print("{:<28} {}".format("responses", statuses))
+    print("{:<28} {:.1f} updates/s".format("long poll throughput" if args.long_poll else "webhook throughput", len(updates) / sent_seconds))
+    if latencies:
+        print("{:<28} p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+            "webhook latency", percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000
+        ))
+    print("{:<28} {:.2f} s ({:.1f} updates/s end to end)".format("drained after", drained_seconds, len(updates) / drained_seconds))
+    print("{:<28} {} ({:.3f} per vote)".format("notion calls", notion_calls, notion_calls / answers if answers else 0.0))
+    print("{:<28} {}".format("429 answered by mock", stats["rate_limited"]))
+    print("{:<28} {}".format("dead letter updates", queue["dead"]))
+    print()
+    for endpoint, count in sorted(stats["calls"].items()):
+        print("  {:<40} {}".format(endpoint, count))
+    print("workdir {}".format(workdir))
+
+    ingest_queue.stop_workers()
+    result_coalescer.stop()
+    vote_writer.stop()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
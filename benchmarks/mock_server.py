@@ -0,0 +1,216 @@
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Local stand-in for the Notion and Telegram apis used by the bot. Notion pages
+# are kept in memory so the database queries made by app.py find what was
+# created. Every call can be delayed and a share of them answered with 429.
+# Point the bot at it with NOTION_API_URL=http://host:port/v1 and
+# TELEGRAM_API_URL=http://host:port.
+class MockState:
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_share=0.0, retry_after=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.calls = {}
+        self.rate_limited = 0
+        self.message_id = 0
+        # Served by getUpdates, oldest first
+        self.updates = []
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "rate_limited": self.rate_limited, "pages": len(self.pages)}
+
+    def add_updates(self, updates):
+        with self.lock:
+            self.updates.extend(updates)
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.rate_limited = 0
+
+
+def _text(prop):
+    value = prop.get("title") or prop.get("rich_text") or []
+    return "".join(part.get("plain_text") or part.get("text", {}).get("content", "") for part in value)
+
+
+def _matches(page, condition):
+    if "and" in condition:
+        return all(_matches(page, c) for c in condition["and"])
+    if "or" in condition:
+        return any(_matches(page, c) for c in condition["or"])
+    prop = page["properties"].get(condition.get("property"), {})
+    if "title" in condition or "rich_text" in condition:
+        rule = condition.get("title") or condition.get("rich_text")
+        text = _text(prop)
+        if "equals" in rule:
+            return text == rule["equals"]
+        return rule.get("contains", "") in text
+    if "number" in condition:
+        return prop.get("number") == condition["number"].get("equals")
+    if "date" in condition:
+        return (prop.get("date") or {}).get("start") == condition["date"].get("equals")
+    return True
+
+
+def _typed(properties):
+    # Notion answers with the type of every property next to its value
+    return {name: dict(value, type=next(iter(value))) if "type" not in value else value for name, value in properties.items()}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        state = self.state
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        path = self.path.split("?")[0]
+        telegram = path.startswith("/bot")
+        endpoint = "telegram {}".format(path.rsplit("/", 1)[-1]) if telegram else "notion {} {}".format(self.command, re.sub(r"/[0-9a-f-]{32,36}", "/{id}", path))
+        state.count(endpoint)
+
+        delay = state.latency + (state.random.uniform(0, state.jitter) if state.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if state.rate_limit_share and state.random.random() < state.rate_limit_share:
+            with state.lock:
+                state.rate_limited += 1
+            if telegram:
+                return self._reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": state.retry_after}})
+            return self._reply(429, {"object": "error", "status": 429, "code": "rate_limited"}, {"Retry-After": str(state.retry_after)})
+
+        try:
+            body = json.loads(raw) if raw and "json" in (self.headers.get("Content-Type") or "") else {}
+        except ValueError:
+            body = {}
+        if telegram:
+            params = {name: values[-1] for name, values in parse_qs(self.path.partition("?")[2]).items()}
+            return self._telegram(path.rsplit("/", 1)[-1], params)
+        return self._notion(path, body)
+
+    def _telegram(self, method, params):
+        state = self.state
+        if method == "getUpdates":
+            # Updates below the offset count as confirmed and are dropped, like telegram does
+            offset, limit = int(params.get("offset") or 0), int(params.get("limit") or 100)
+            with state.lock:
+                state.updates = [update for update in state.updates if update["update_id"] >= offset]
+                result = state.updates[:limit]
+            if not result and params.get("timeout"):
+                # A short hold instead of the real long poll timeout keeps the tests fast
+                time.sleep(min(float(params["timeout"]), 0.1))
+            return self._reply(200, {"ok": True, "result": result})
+
+        with state.lock:
+            state.message_id += 1
+            message_id = state.message_id
+        result = {"message_id": message_id, "chat": {"id": 0}}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": "mock-file-{}".format(message_id)}]
+        elif method in ("sendPoll", "stopPoll"):
+            result["poll"] = {"id": "mock-poll-{}".format(message_id), "options": [], "is_closed": method == "stopPoll"}
+        return self._reply(200, {"ok": True, "result": result})
+
+    def _notion(self, path, body):
+        state = self.state
+        parts = path.strip("/").split("/")
+        if len(parts) == 4 and parts[1] == "databases" and parts[3] == "query":
+            with state.lock:
+                pages = [page for page in state.pages.values() if page["parent"]["database_id"] == parts[2] and not page["archived"]]
+            if body.get("filter"):
+                pages = [page for page in pages if _matches(page, body["filter"])]
+            start = int(body.get("start_cursor") or 0)
+            size = int(body.get("page_size") or 100)
+            more = start + size < len(pages)
+            return self._reply(200, {"object": "list", "results": pages[start:start + size], "has_more": more, "next_cursor": str(start + size) if more else None})
+
+        if parts[1:] == ["pages"] and self.command == "POST":
+            now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+            page = {"object": "page", "id": str(uuid.uuid4()), "parent": body.get("parent", {}), "properties": _typed(body.get("properties", {})),
+                    "archived": False, "created_time": now, "last_edited_time": now}
+            with state.lock:
+                state.pages[page["id"]] = page
+            return self._reply(200, page)
+
+        if len(parts) == 3 and parts[1] == "pages":
+            with state.lock:
+                page = state.pages.get(parts[2])
+                if page is not None and self.command == "PATCH":
+                    page["properties"].update(_typed(body.get("properties", {})))
+                    page["archived"] = body.get("archived", page["archived"])
+                    page["last_edited_time"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+            if page is None:
+                return self._reply(404, {"object": "error", "status": 404, "code": "object_not_found"})
+            return self._reply(200, page)
+
+        return self._reply(404, {"object": "error", "status": 404, "code": "invalid_request_url"})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+def start(host="127.0.0.1", port=0, **options):
+    state = MockState(**options)
+    handler = type("Handler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server, state
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Mock Notion and Telegram api server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds added on top, uniformly")
+    parser.add_argument("--rate-limit-share", type=float, default=0.0, help="Share of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with a 429")
+    args = parser.parse_args(argv)
+
+    server, state = start(args.host, args.port, latency=args.latency, jitter=args.jitter, rate_limit_share=args.rate_limit_share, retry_after=args.retry_after)
+    print("Mock server on http://{}:{} (NOTION_API_URL=http://{}:{}/v1)".format(args.host, server.server_port, args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(state.stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
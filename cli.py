@@ -0,0 +1,51 @@
+import os
+import sys
+import argparse
+
+
+# Small entry point for the short lived runs (cron, the scheduler host). Only
+# the modules of the chosen command are imported, so stopping a poll does not
+# pay for the OCR, pipeline or webhook dependencies.
+def stop(args):
+    import logging
+    import scheduler
+    import http_client
+    from stop_poll import stop_poll
+
+    chat_id = args.chat_id or os.getenv("CHANNEL_ID")
+    logging.info("Stopping the poll with message id - %s", args.message_id)
+    resp = stop_poll(os.getenv("API_KEY"), chat_id, args.message_id)
+    scheduler.finalize_stopped_poll(resp, args.message_id, args.poll_id)
+    logging.info("Outbound api call metrics - %s", http_client.get_metrics())
+    print("{} {}".format(resp["Status"], (resp.get("Response") or {}).get("description", "")).strip())
+    return 0 if resp["Status"] == "Success" else 1
+
+
+def send(args):
+    import send_poll
+
+    resp = send_poll.main(blocking_wait=not args.no_wait)
+    print("{} {}".format(resp["Status"], resp.get("Stage", "")).strip())
+    return 0 if resp["Status"] in ("Success", "Deferred") else 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Send or stop the daily poll")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stop_parser = subparsers.add_parser("stop", help="Close a poll")
+    stop_parser.add_argument("message_id", type=int)
+    stop_parser.add_argument("--chat-id", help="Chat the poll was sent to, CHANNEL_ID by default")
+    stop_parser.add_argument("--poll-id", help="Telegram id of the poll, lets the result be reconciled if the poll was closed already")
+    stop_parser.set_defaults(func=stop)
+
+    send_parser = subparsers.add_parser("send", help="Run the daily send flow")
+    send_parser.add_argument("--no-wait", action="store_true", help="Stop at the wait before the poll instead of sleeping, run again to resume")
+    send_parser.set_defaults(func=send)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
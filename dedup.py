@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import atexit
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# Telegram re-sends an update it got no fast answer for. Replays are dropped by
+# update_id, and a poll answer is dropped when it repeats the user's last answer
+# in that poll, which also catches a replay that arrives with a new update_id.
+dedup_state_file = os.getenv("DEDUP_STATE_FILE") or os.path.join(cwd, "dedup_state.json")
+dedup_window = float(os.getenv("DEDUP_WINDOW", "3600"))
+max_entries = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+# How many of the latest update ids are saved, everything below the oldest of them counts as processed after a restart
+persist_count = int(os.getenv("DEDUP_PERSIST_COUNT", "1000"))
+save_interval = float(os.getenv("DEDUP_SAVE_INTERVAL", "1"))
+
+_lock = threading.Lock()
+# update_id -> time it was seen, in arrival order
+_updates = OrderedDict()
+# (poll_id, user_id) -> (option ids, time it was seen)
+_answers = OrderedDict()
+_low_watermark = None
+_last_save = 0.0
+_dirty = False
+_loaded = False
+
+
+def _load():
+    global _loaded, _low_watermark
+    if _loaded:
+        return
+    _loaded = True
+    try:
+        with open(dedup_state_file) as infile:
+            state = json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return
+
+    now = time.time()
+    for update_id in reversed(state.get("recent", [])):
+        _updates[update_id] = now
+    _low_watermark = state.get("low_watermark")
+    logging.info("Loaded the dedup watermark %s and %s recent update ids.", _low_watermark, len(_updates))
+
+
+def _save(now):
+    global _last_save, _dirty
+    recent = list(itertools.islice(reversed(_updates), persist_count))
+    # Ids that dropped out of the saved list are covered by the watermark
+    low_watermark = _low_watermark
+    if len(recent) >= persist_count:
+        low_watermark = min(recent) if low_watermark is None else max(low_watermark, min(recent))
+    tmp_file = dedup_state_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump({"low_watermark": low_watermark, "recent": recent}, outfile)
+    os.replace(tmp_file, dedup_state_file)
+    _last_save, _dirty = now, False
+
+
+def _expire(now):
+    global _low_watermark
+    cutoff = now - dedup_window
+    while _updates:
+        update_id, seen_at = next(iter(_updates.items()))
+        if seen_at >= cutoff and len(_updates) <= max_entries:
+            break
+        _updates.popitem(last=False)
+        # An id that left the window must still not be processed again
+        _low_watermark = update_id if _low_watermark is None else max(_low_watermark, update_id)
+    while _answers:
+        _, (_, seen_at) = next(iter(_answers.items()))
+        if seen_at >= cutoff and len(_answers) <= max_entries:
+            break
+        _answers.popitem(last=False)
+
+
+def _answer_key(update):
+    answer = update.get("poll_answer")
+    if not answer or "option_ids" not in answer:
+        return None, None
+    return (answer["poll_id"], answer["user"]["id"]), tuple(answer["option_ids"])
+
+
+def accept(update):
+    # Returns a token when the update is new and records it, None for a replay.
+    # Pass the token to release() if the update could not be taken in after all.
+    global _dirty
+    update_id = update.get("update_id")
+    key, options = _answer_key(update)
+    now = time.time()
+
+    with _lock:
+        _load()
+        _expire(now)
+        if update_id is not None and (update_id in _updates or (_low_watermark is not None and update_id <= _low_watermark)):
+            return None
+        previous = _answers.get(key) if key is not None else None
+        if previous is not None and previous[0] == options:
+            return None
+
+        if update_id is not None:
+            _updates[update_id] = now
+            _dirty = True
+        if key is not None:
+            _answers[key] = (options, now)
+            _answers.move_to_end(key)
+
+        if _dirty and now - _last_save >= save_interval:
+            try:
+                _save(now)
+            except Exception as e:
+                logging.error("Unable to save the dedup state. Error - %s", e)
+    return {"update_id": update_id, "key": key, "previous": previous}
+
+
+def release(token):
+    with _lock:
+        if token["update_id"] is not None:
+            _updates.pop(token["update_id"], None)
+        if token["key"] is not None:
+            if token["previous"] is None:
+                _answers.pop(token["key"], None)
+            else:
+                _answers[token["key"]] = token["previous"]
+
+
+def flush():
+    with _lock:
+        if _dirty:
+            _save(time.time())
+
+
+def stats():
+    with _lock:
+        return {"update_ids": len(_updates), "answers": len(_answers), "low_watermark": _low_watermark}
+
+
+atexit.register(flush)
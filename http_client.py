@@ -0,0 +1,226 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+notion_api_url = os.getenv("NOTION_API_URL", "https://api.notion.com/v1")
+telegram_api_url = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+notion_version = "2022-06-28"
+
+connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+max_retries = int(os.getenv("HTTP_MAX_RETRIES", "5"))
+backoff_base = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+backoff_cap = float(os.getenv("HTTP_BACKOFF_CAP", "30"))
+pool_size = int(os.getenv("HTTP_POOL_SIZE", "20"))
+# Notion allows an average of three requests per second per integration
+notion_rate_limit = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+notion_burst = int(os.getenv("NOTION_BURST", "3"))
+# Telegram allows about 30 messages per second overall and 20 per minute in one group or channel
+telegram_rate_limit = float(os.getenv("TELEGRAM_RATE_LIMIT", "30"))
+telegram_chat_rate_limit = float(os.getenv("TELEGRAM_CHAT_RATE_LIMIT", str(20 / 60)))
+telegram_chat_burst = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+
+# Statuses worth retrying for any request, and the extra ones that are only
+# safe to retry when repeating the request cannot create a second entry.
+retry_statuses = {429, 503}
+idempotent_retry_statuses = {500, 502, 504}
+idempotent_methods = {"GET", "HEAD", "PUT", "DELETE", "PATCH", "OPTIONS"}
+
+_id_pattern = re.compile(r"/[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}")
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+_metrics_lock = threading.Lock()
+_metrics = {}
+
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+notion_limiter = RateLimiter(notion_rate_limit, notion_burst)
+telegram_limiter = RateLimiter(telegram_rate_limit, int(max(1, telegram_rate_limit)))
+_telegram_chat_limiters = {}
+
+
+def notion_headers(notion_token=None):
+    return {
+        "Authorization": "Bearer " + (notion_token or os.getenv("NOTION_TOKEN")),
+        "Content-Type": "application/json",
+        "Notion-Version": notion_version
+    }
+
+
+def _record(endpoint, elapsed, error, retried):
+    metrics.observe("pollbot_outbound_seconds", elapsed, endpoint=endpoint)
+    if error:
+        metrics.inc("pollbot_outbound_errors_total", endpoint=endpoint)
+    if retried:
+        metrics.inc("pollbot_outbound_retries_total", endpoint=endpoint)
+    with _metrics_lock:
+        stats = _metrics.setdefault(endpoint, {"count": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["count"] += 1
+        stats["errors"] += 1 if error else 0
+        stats["retries"] += 1 if retried else 0
+        stats["total_seconds"] += elapsed
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+
+
+def get_metrics():
+    with _metrics_lock:
+        metrics = {endpoint: dict(stats) for endpoint, stats in _metrics.items()}
+    for stats in metrics.values():
+        stats["avg_seconds"] = stats["total_seconds"] / stats["count"] if stats["count"] else 0.0
+    return metrics
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        # Telegram reports the wait in the body instead of the header
+        try:
+            value = response.json().get("parameters", {}).get("retry_after")
+        except Exception:
+            value = None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(backoff_cap, backoff_base * (2 ** attempt)))
+
+
+def _not_sent(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # requests wraps urllib3's MaxRetryError, whose reason is the error that stopped the connection
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def request(method, url, endpoint=None, idempotent=None, limiter=None, **kwargs):
+    method = method.upper()
+    endpoint = endpoint or "{} {}".format(method, url)
+    idempotent = method in idempotent_methods if idempotent is None else idempotent
+    kwargs.setdefault("timeout", (connect_timeout, read_timeout))
+
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = _session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record(endpoint, time.perf_counter() - start, True, attempt > 0)
+            # Anything after the request was sent (read timeout, dropped connection) may mean it went
+            # through, so only repeat it when that is harmless
+            retryable = idempotent or _not_sent(e)
+            if not retryable or attempt >= max_retries:
+                raise
+            delay = _backoff(attempt)
+            logging.warning("Request to %s failed. Retrying in %.2f seconds. Error - %s", endpoint, delay, e)
+        else:
+            _record(endpoint, time.perf_counter() - start, response.status_code >= 400, attempt > 0)
+            retryable = response.status_code in retry_statuses or (idempotent and response.status_code in idempotent_retry_statuses)
+            if not retryable or attempt >= max_retries:
+                return response
+            delay = _backoff(attempt)
+            retry_after = _retry_after(response)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            logging.warning("Request to %s returned %s. Retrying in %.2f seconds.", endpoint, response.status_code, delay)
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def notion_request(method, path, notion_token=None, **kwargs):
+    kwargs["headers"] = dict(notion_headers(notion_token), **kwargs.get("headers", {}))
+    endpoint = "notion {} {}".format(method.upper(), _id_pattern.sub("/{id}", path))
+    # Database queries are sent with POST but only read data
+    idempotent = True if path.endswith("/query") else None
+    return request(method, notion_api_url + path, endpoint=endpoint, idempotent=kwargs.pop("idempotent", idempotent), limiter=notion_limiter, **kwargs)
+
+
+def notion_query_pages(database_id, payload=None, notion_token=None, page_size=100):
+    # Yields the result pages of a database query, following next_cursor until
+    # has_more is false. Raises if notion answers with an error on any page.
+    payload = dict(payload or {}, page_size=page_size)
+    path = "/databases/{}/query".format(database_id)
+    while True:
+        resp = notion_request("POST", path, notion_token, json=payload)
+        resp.raise_for_status()
+        resp_json = resp.json()
+        yield resp_json["results"]
+        if not resp_json.get("has_more") or not resp_json.get("next_cursor"):
+            break
+        payload["start_cursor"] = resp_json["next_cursor"]
+
+
+def notion_query_all(database_id, payload=None, notion_token=None):
+    return [page for results in notion_query_pages(database_id, payload, notion_token) for page in results]
+
+
+class _TelegramLimiter:
+    def __init__(self, chat_limiter):
+        self.chat_limiter = chat_limiter
+
+    def acquire(self):
+        if self.chat_limiter is not None:
+            self.chat_limiter.acquire()
+        telegram_limiter.acquire()
+
+
+def _telegram_chat_limiter(kwargs):
+    chat_id = None
+    for key in ("params", "data", "json"):
+        if isinstance(kwargs.get(key), dict) and "chat_id" in kwargs[key]:
+            chat_id = str(kwargs[key]["chat_id"])
+    if chat_id is None:
+        return None
+    with _metrics_lock:
+        limiter = _telegram_chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = _telegram_chat_limiters[chat_id] = RateLimiter(telegram_chat_rate_limit, telegram_chat_burst)
+    return limiter
+
+
+def telegram_request(method, bot_method, bot_token, **kwargs):
+    url = "{}/bot{}/{}".format(telegram_api_url, bot_token, bot_method)
+    limiter = _TelegramLimiter(_telegram_chat_limiter(kwargs))
+    return request(method, url, endpoint="telegram {}".format(bot_method), idempotent=kwargs.pop("idempotent", False), limiter=limiter, **kwargs)
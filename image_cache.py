@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+image_cache_file = os.getenv("IMAGE_CACHE_FILE") or os.path.join(cwd, "image_cache.json")
+chunk_size = 64 * 1024
+
+_lock = threading.Lock()
+_images = {}
+_cache = None
+
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(image_cache_file) as infile:
+                _cache = json.load(infile)
+        except (FileNotFoundError, ValueError):
+            _cache = {}
+        _cache.setdefault("etags", {})
+        _cache.setdefault("file_ids", {})
+    return _cache
+
+
+def _save_cache():
+    tmp_file = image_cache_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump(_cache, outfile)
+    os.replace(tmp_file, image_cache_file)
+
+
+def _get(section, key):
+    with _lock:
+        return _load_cache()[section].get(key)
+
+
+def _set(section, key, value):
+    with _lock:
+        _load_cache()[section][key] = value
+        try:
+            _save_cache()
+        except Exception as e:
+            logging.error("Unable to save the image cache. Error - {}".format(e))
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_image(path):
+    # The OCR and sendPhoto stages share one in-memory copy of the image
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        image = _images.get(key)
+    if image is None:
+        with open(path, "rb") as infile:
+            content = infile.read()
+        image = {"content": content, "hash": hashlib.sha256(content).hexdigest()}
+        with _lock:
+            _images.clear()
+            _images[key] = image
+    return image
+
+
+def get_etag(url):
+    return _get("etags", url)
+
+
+def set_etag(url, etag):
+    _set("etags", url, etag)
+
+
+def get_file_id(content_hash):
+    return _get("file_ids", content_hash)
+
+
+def set_file_id(content_hash, file_id):
+    _set("file_ids", content_hash, file_id)
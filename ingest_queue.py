@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+queue_db = os.getenv("INGEST_QUEUE_DB") or os.path.join(cwd, "ingest_queue.db")
+worker_count = int(os.getenv("INGEST_WORKERS", "4"))
+max_depth = int(os.getenv("INGEST_MAX_DEPTH", "10000"))
+max_attempts = int(os.getenv("INGEST_MAX_ATTEMPTS", "5"))
+claim_timeout = int(os.getenv("INGEST_CLAIM_TIMEOUT", "300"))
+
+_local = threading.local()
+_lock = threading.Lock()
+_new_update = threading.Condition()
+_stop = threading.Event()
+_workers = []
+_depth = None
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(queue_db, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS updates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                partition_key INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                dead INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS updates_claim ON updates (dead, claimed_at, id)")
+        _local.conn = conn
+    return conn
+
+
+def _load_depth():
+    global _depth
+    with _lock:
+        if _depth is None:
+            _depth = _connection().execute("SELECT COUNT(*) FROM updates WHERE dead = 0").fetchone()[0]
+    return _depth
+
+
+def _partition_key(key):
+    return zlib.crc32(str(key).encode("utf-8"))
+
+
+def enqueue(update, key):
+    # Updates sharing a key (same poll, or same user in a poll) land in the same
+    # partition, so one worker applies them in the order telegram sent them.
+    if _load_depth() >= max_depth:
+        return False
+
+    _connection().execute(
+        "INSERT INTO updates (partition_key, payload, enqueued_at) VALUES (?, ?, ?)",
+        (_partition_key(key), json.dumps(update), time.time())
+    )
+
+    global _depth
+    with _lock:
+        _depth += 1
+    with _new_update:
+        _new_update.notify_all()
+    return True
+
+
+def has_pending(key):
+    # An update of the key's partition is waiting or being worked on, a later
+    # update of the key has to be queued behind it instead of applied directly
+    if _load_depth() == 0:
+        return False
+    row = _connection().execute(
+        "SELECT 1 FROM updates WHERE dead = 0 AND partition_key = ? LIMIT 1", (_partition_key(key),)
+    ).fetchone()
+    return row is not None
+
+
+def _claim(worker_index):
+    conn = _connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT id, payload, attempts, claimed_at FROM updates "
+            "WHERE dead = 0 AND partition_key % ? = ? "
+            "ORDER BY id LIMIT 1",
+            (worker_count, worker_index)
+        ).fetchone()
+        # The oldest update is still being worked on, the later ones have to wait for it
+        if row is not None and row[3] is not None and row[3] >= now - claim_timeout:
+            row = None
+        if row is not None:
+            conn.execute("UPDATE updates SET claimed_at = ? WHERE id = ?", (now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row[:3] if row is not None else None
+
+
+def _ack(update_row_id):
+    global _depth
+    _connection().execute("DELETE FROM updates WHERE id = ?", (update_row_id,))
+    with _lock:
+        _depth -= 1
+
+
+def _release(update_row_id, attempts):
+    global _depth
+    if attempts + 1 >= max_attempts:
+        logging.error("Update %s failed %s times. Moving it to the dead letter entries.", update_row_id, attempts + 1)
+        _connection().execute("UPDATE updates SET dead = 1, attempts = attempts + 1 WHERE id = ?", (update_row_id,))
+        with _lock:
+            _depth -= 1
+    else:
+        _connection().execute("UPDATE updates SET claimed_at = NULL, attempts = attempts + 1 WHERE id = ?", (update_row_id,))
+
+
+def _work(worker_index, handler):
+    while not _stop.is_set():
+        try:
+            row = _claim(worker_index)
+        except Exception as e:
+            logging.error("Unable to claim an update from the ingestion queue. Error - %s", e)
+            row = None
+
+        if row is None:
+            with _new_update:
+                _new_update.wait(timeout=1)
+            continue
+
+        update_row_id, payload, attempts = row
+        try:
+            handler(json.loads(payload))
+            _ack(update_row_id)
+        except Exception as e:
+            logging.error("Unable to process update %s from the ingestion queue. Error - %s", update_row_id, e)
+            _release(update_row_id, attempts)
+            # Give the failing partition a short pause before it is retried
+            time.sleep(min(2 ** attempts, 30))
+
+
+def start_workers(handler):
+    with _lock:
+        if _workers:
+            return
+        _stop.clear()
+        # Claims left by a process that stopped mid update, so they are picked up first again
+        released = _connection().execute("UPDATE updates SET claimed_at = NULL WHERE dead = 0 AND claimed_at IS NOT NULL").rowcount
+        if released:
+            logging.info("Released %s updates claimed by a previous run.", released)
+        for worker_index in range(worker_count):
+            worker = threading.Thread(target=_work, args=(worker_index, handler), name="ingest-worker-{}".format(worker_index), daemon=True)
+            worker.start()
+            _workers.append(worker)
+    logging.info("Started %s ingestion queue workers.", worker_count)
+
+
+def stop_workers(timeout=None):
+    _stop.set()
+    with _new_update:
+        _new_update.notify_all()
+    for worker in _workers:
+        worker.join(timeout)
+    del _workers[:]
+
+
+def queue_stats():
+    pending, in_flight, dead = _connection().execute(
+        "SELECT "
+        "COALESCE(SUM(dead = 0 AND claimed_at IS NULL), 0), "
+        "COALESCE(SUM(dead = 0 AND claimed_at IS NOT NULL), 0), "
+        "COALESCE(SUM(dead = 1), 0) "
+        "FROM updates"
+    ).fetchone()
+    return {"depth": pending + in_flight, "pending": pending, "in_flight": in_flight, "dead": dead, "max_depth": max_depth, "workers": len(_workers)}
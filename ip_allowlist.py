@@ -0,0 +1,82 @@
+import os
+import bisect
+import functools
+import logging
+import ipaddress
+from dotenv import load_dotenv
+
+load_dotenv()
+
+default_telegram_ip_ranges = ['149.154.160.0/20', '91.108.4.0/22']
+
+
+def _split(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def compile_ranges(ip_ranges):
+    # Each network becomes an integer (start, end) pair per IP version. Overlapping
+    # ranges are merged so a single bisect tells whether an address is inside.
+    ranges = {4: [], 6: []}
+    for ip_range in ip_ranges:
+        network = ipaddress.ip_network(ip_range, strict=False)
+        ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+    compiled = {}
+    for version, pairs in ranges.items():
+        merged = []
+        for start, end in sorted(pairs):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        compiled[version] = ([start for start, _ in merged], [end for _, end in merged])
+    return compiled
+
+
+def in_ranges(compiled, address):
+    starts, ends = compiled[address.version]
+    index = bisect.bisect_right(starts, int(address)) - 1
+    return index >= 0 and int(address) <= ends[index]
+
+
+# Telegram delivers from a handful of addresses, so the parsed form is remembered
+@functools.lru_cache(maxsize=4096)
+def parse_address(value):
+    try:
+        address = ipaddress.ip_address(value.strip())
+    except ValueError:
+        return None
+    # An IPv4 client seen through a dual stack socket arrives as ::ffff:a.b.c.d
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+allowed_ranges = compile_ranges(_split(os.getenv("TELEGRAM_IP_RANGES", "")) or default_telegram_ip_ranges)
+trusted_proxies = compile_ranges(_split(os.getenv("TRUSTED_PROXIES", "")))
+
+
+def client_address(remote_addr, forwarded_for=""):
+    # X-Forwarded-For is only believed when the direct peer is one of our proxies. The
+    # header is walked from the right, skipping our own proxies, and the first hop
+    # that is not one of them is the client.
+    address = parse_address(remote_addr or "")
+    if address is None or not forwarded_for or not in_ranges(trusted_proxies, address):
+        return address
+
+    for hop in reversed(forwarded_for.split(",")):
+        hop_address = parse_address(hop)
+        if hop_address is None:
+            return None
+        if not in_ranges(trusted_proxies, hop_address):
+            return hop_address
+    return address
+
+
+def is_allowed(remote_addr, forwarded_for=""):
+    address = client_address(remote_addr, forwarded_for)
+    if address is None:
+        logging.error("Unable to validate the source of the request. Invalid address - %s", remote_addr)
+        return False
+    return in_ranges(allowed_ranges, address)
@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+log_dir = os.getenv("LOG_DIR") or cwd
+log_level = os.getenv("LOG_LEVEL", "INFO")
+# json for one structured record per line, text for the old app.log format
+log_format = os.getenv("LOG_FORMAT", "json")
+log_max_bytes = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+log_backup_count = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Payloads (updates, api responses) are cut to this many characters, and only
+# this share of the records carrying one is written at all
+payload_limit = int(os.getenv("LOG_PAYLOAD_LIMIT", "1000"))
+payload_sample_rate = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1"))
+
+text_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_lock = threading.Lock()
+_listener = None
+
+
+class payload:
+    # Wraps an object logged as a %s argument. Nothing is serialized unless the
+    # record is actually written, and then at most payload_limit characters.
+    # A callable (e.g. resp.json) is only called at that point as well.
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value() if callable(self.value) else self.value
+        try:
+            text = value if isinstance(value, str) else json.dumps(value, default=str)
+        except Exception:
+            text = str(value)
+        if len(text) > payload_limit:
+            return "{}... ({} chars truncated)".format(text[:payload_limit], len(text) - payload_limit)
+        return text
+
+
+def set_request_id(request_id):
+    return _request_id.set(None if request_id is None else str(request_id))
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+class _ContextFilter(logging.Filter):
+    # Runs in the thread that logs, before the record is handed to the queue
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        if payload_sample_rate < 1 and isinstance(record.args, tuple) and any(isinstance(arg, payload) for arg in record.args):
+            return random.random() < payload_sample_rate
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The queue stays in this process, so the record is passed as it is and
+        # formatted by the listener. Plain arguments are turned into strings now
+        # so later changes to them do not show up in the log, payloads stay lazy.
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg if isinstance(arg, (payload, int, float)) else str(arg) for arg in record.args)
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "thread": record.threadName,
+            "request_id": getattr(record, "request_id", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(process_name=None):
+    # Each script writes to its own rotating <process_name>.log, named after the
+    # script that was started unless given. The file is written by a listener
+    # thread, callers only put the record on a queue.
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        process_name = process_name or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = RotatingFileHandler(os.path.join(log_dir, "{}.log".format(process_name)), maxBytes=log_max_bytes, backupCount=log_backup_count)
+        file_handler.setFormatter(JsonFormatter() if log_format == "json" else logging.Formatter(text_format))
+
+        queue_handler = _QueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(_ContextFilter())
+
+        root = logging.getLogger()
+        root.setLevel(log_level)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+
+        _listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
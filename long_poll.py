@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import threading
+import app
+import dedup
+import metrics
+import log_setup
+import http_client
+import ingest_queue
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# Alternative to the webhook for hosts telegram cannot reach. Updates are pulled
+# with getUpdates in batches and go through the same steps as the ones posted to
+# app.py, without the per request routing, ip check and json parsing.
+bot_token = os.getenv("API_KEY")
+batch_limit = min(100, int(os.getenv("LONG_POLL_LIMIT", "100")))
+poll_timeout = int(os.getenv("LONG_POLL_TIMEOUT", "30"))
+error_delay = float(os.getenv("LONG_POLL_ERROR_DELAY", "5"))
+offset_file = os.getenv("LONG_POLL_OFFSET_FILE") or os.path.join(cwd, "long_poll_offset.json")
+allowed_updates = ["poll", "poll_answer"]
+
+_stop = threading.Event()
+
+
+def load_offset():
+    try:
+        with open(offset_file) as infile:
+            return json.load(infile).get("offset")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_offset(offset):
+    tmp_file = offset_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump({"offset": offset, "saved_at": time.time()}, outfile)
+    os.replace(tmp_file, offset_file)
+
+
+def get_updates(offset):
+    params = {"limit": batch_limit, "timeout": poll_timeout, "allowed_updates": json.dumps(allowed_updates)}
+    if offset is not None:
+        params["offset"] = offset
+    # The read timeout has to outlast the time telegram holds the request open
+    resp = http_client.telegram_request("GET", "getUpdates", bot_token, params=params, idempotent=True,
+                                        timeout=(http_client.connect_timeout, poll_timeout + http_client.read_timeout))
+    return resp.json()
+
+
+def delete_webhook():
+    # getUpdates is refused while a webhook is set. Pending updates are kept.
+    resp = http_client.telegram_request("POST", "deleteWebhook", bot_token, data={"drop_pending_updates": False})
+    logging.info("Response from delete webhook api call - %s", log_setup.payload(resp.json))
+    return resp.json().get("ok", False)
+
+
+def get_poll_id(update):
+    if "poll" in update:
+        return update["poll"]["id"]
+    return update["poll_answer"]["poll_id"]
+
+
+def group_batch(updates):
+    # Returns poll id -> (update, dedup token) of that poll in the order telegram
+    # sent them. Only the newest result of a poll is kept, it supersedes the older counts.
+    groups = {}
+    for update in updates:
+        if app.get_update_key(update) is None:
+            metrics.inc("pollbot_updates_total", type="ignored")
+            continue
+        seen = dedup.accept(update)
+        if seen is None:
+            logging.info("Update %s was already received. Dropping the replay.", update.get("update_id"))
+            metrics.inc("pollbot_updates_total", type="duplicate")
+            continue
+
+        poll_updates = groups.setdefault(get_poll_id(update), [])
+        if "poll" in update:
+            poll_updates[:] = [queued for queued in poll_updates if "poll" not in queued[0]]
+        poll_updates.append((update, seen))
+    return groups
+
+
+def take_in(update):
+    key = app.get_update_key(update)
+    # An earlier update of the key is still in the queue, applying this one now would overtake it
+    if ingest_queue.has_pending(key):
+        return ingest_queue.enqueue(update, key)
+    try:
+        app.process_update(update)
+        return True
+    except Exception as e:
+        # The queue retries it and dead letters it after too many attempts, like a webhook update
+        logging.error("Unable to process update %s. Passing it to the ingestion queue. Error - %s", update.get("update_id"), e)
+        return ingest_queue.enqueue(update, key)
+
+
+def dispatch(updates):
+    # Returns how many updates were taken in and the offset to get the next batch from
+    groups = group_batch(updates)
+    processed, held = 0, []
+    for poll_id, poll_updates in groups.items():
+        logging.info("Processing %s updates of poll %s from the batch.", len(poll_updates), poll_id)
+        for update, seen in poll_updates:
+            # Once the queue is full the rest of the batch is left for the next getUpdates
+            if not held and take_in(update):
+                processed += 1
+            else:
+                held.append((update, seen))
+
+    if not held:
+        return processed, updates[-1]["update_id"] + 1
+    # Telegram sends them again from the offset, which must not count as a replay.
+    # Released newest first so each answer goes back to what it was before the batch.
+    for update, seen in reversed(held):
+        dedup.release(seen)
+    metrics.inc("pollbot_updates_total", len(held), type="queue_full")
+    logging.error("Ingestion queue is full. Leaving %s updates with telegram until it drains.", len(held))
+    return processed, min(update["update_id"] for update, _ in held)
+
+
+def run_forever(webhook_delete=False):
+    app.start_background_workers()
+    if webhook_delete and not delete_webhook():
+        logging.error("Unable to delete the webhook. Exiting....")
+        return
+
+    offset = load_offset()
+    logging.info("Long polling for updates from offset %s in batches of up to %s.", offset, batch_limit)
+    while not _stop.is_set():
+        try:
+            with metrics.stage("get_updates"):
+                resp_json = get_updates(offset)
+        except Exception as e:
+            logging.error("Unable to get updates from telegram. Error - %s", e)
+            _stop.wait(error_delay)
+            continue
+
+        if not resp_json.get("ok"):
+            if resp_json.get("error_code") == 409:
+                logging.error("A webhook is set for the bot, run with --delete-webhook to switch to long polling.")
+            else:
+                logging.error("Get updates api call failed - %s", log_setup.payload(resp_json))
+            _stop.wait(error_delay)
+            continue
+
+        updates = resp_json["result"]
+        if not updates:
+            continue
+
+        with metrics.stage("long_poll_batch"):
+            processed, next_offset = dispatch(updates)
+        metrics.inc("pollbot_long_poll_batches_total")
+        metrics.inc("pollbot_long_poll_updates_total", len(updates))
+        # Votes are in the local store or the queue by now, so telegram can drop everything up to here
+        offset = next_offset
+        save_offset(offset)
+        logging.info("Processed %s of %s updates, next offset %s.", processed, len(updates), offset)
+        if offset <= updates[-1]["update_id"]:
+            _stop.wait(error_delay)
+
+
+def stop(*args):
+    _stop.set()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Receive poll updates with getUpdates instead of the webhook")
+    parser.add_argument("--delete-webhook", action="store_true", help="Remove the bot's webhook first, telegram refuses getUpdates while one is set")
+    args = parser.parse_args(argv)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    run_forever(args.delete_webhook)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,196 @@
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+import ip_allowlist
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Sampling profiler for slow requests, off unless PROFILE_SLOW_REQUESTS=1 or
+# switched on at runtime. Stacks of requests slower than PROFILE_SLOW_SECONDS
+# are written as folded stacks, the input format of flamegraph.pl and speedscope.
+profile_dir = os.getenv("PROFILE_DIR") or os.path.join(cwd, "profiles")
+profile_slow_seconds = float(os.getenv("PROFILE_SLOW_SECONDS", "1"))
+profile_interval = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {
+    "pollbot_stage_seconds": ("histogram", "Time spent in each stage of handling an update"),
+    "pollbot_updates_total": ("counter", "Updates received by type"),
+    "pollbot_outbound_seconds": ("histogram", "Latency of outbound api calls"),
+    "pollbot_outbound_errors_total": ("counter", "Outbound api calls that failed or returned an error status"),
+    "pollbot_outbound_retries_total": ("counter", "Outbound api calls that were retries"),
+    "pollbot_slow_requests_total": ("counter", "Requests slower than the profiling threshold"),
+}
+
+_profiling = os.getenv("PROFILE_SLOW_REQUESTS", "0") == "1"
+# Separate from _lock, counters and histograms never wait for the sampler
+_profile_lock = threading.Lock()
+_profiled = {}
+_sampler = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(default_buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(default_buckets):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("pollbot_stage_seconds", time.perf_counter() - start, stage=name)
+
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render():
+    # Prometheus text exposition format
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for key, h in _histograms.items()}
+
+    lines = []
+    names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+    for name in names:
+        kind, text = _help.get(name, ("counter" if any(key[0] == name for key in counters) else "histogram", name))
+        lines.append("# HELP {} {}".format(name, text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(default_buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", repr(bound))]), cumulative))
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, [("le", "+Inf")]), histogram["count"]))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), histogram["sum"]))
+            lines.append("{}_count{} {}".format(name, _labels(labels), histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def is_local(remote_addr, forwarded_for=""):
+    # Behind a proxy on the same host every request arrives from loopback, so the
+    # client is resolved like the webhook does, and any forwarded hop must be local too
+    address = ip_allowlist.client_address(remote_addr, forwarded_for)
+    if address is None or not address.is_loopback:
+        return False
+    hops = [ip_allowlist.parse_address(hop) for hop in forwarded_for.split(",")] if forwarded_for else []
+    return all(hop is not None and hop.is_loopback for hop in hops)
+
+
+def profiling_enabled():
+    return _profiling
+
+
+def set_profiling(enabled):
+    global _profiling
+    _profiling = bool(enabled)
+    logging.info("Profiling of slow requests is now %s.", "on" if _profiling else "off")
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def _sample():
+    global _sampler
+    while True:
+        with _profile_lock:
+            if not _profiled:
+                _sampler = None
+                return
+            profiled = dict(_profiled)
+        frames = sys._current_frames()
+        stacks = {ident: _fold(frames[ident]) for ident in profiled if ident in frames}
+        del frames
+        with _profile_lock:
+            for ident, stack in stacks.items():
+                # The request may have ended while its stack was folded
+                if _profiled.get(ident) is profiled[ident]:
+                    profiled[ident][stack] += 1
+        time.sleep(profile_interval)
+
+
+def _write_profile(name, samples, elapsed):
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_file = os.path.join(profile_dir, "{}_{}_{:.0f}ms.folded".format(time.strftime("%Y%m%d-%H%M%S"), name, elapsed * 1000))
+    with open(profile_file, "w") as outfile:
+        for stack, count in samples.most_common():
+            outfile.write("{} {}\n".format(stack, count))
+    logging.info("Request %s took %.3f seconds. Saved its profile to %s", name, elapsed, profile_file)
+
+
+@contextmanager
+def profile_request(name):
+    # Samples the stack of the calling thread while the block runs
+    global _sampler
+    if not _profiling:
+        yield
+        return
+
+    ident = threading.get_ident()
+    samples = collections.Counter()
+    start = time.perf_counter()
+    with _profile_lock:
+        _profiled[ident] = samples
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample, name="profiler", daemon=True)
+            _sampler.start()
+    try:
+        yield
+    finally:
+        with _profile_lock:
+            _profiled.pop(ident, None)
+        elapsed = time.perf_counter() - start
+        if elapsed >= profile_slow_seconds:
+            inc("pollbot_slow_requests_total", request=name)
+            if samples:
+                try:
+                    _write_profile(name, samples, elapsed)
+                except Exception as e:
+                    logging.error("Unable to save the profile of a slow request. Error - %s", e)
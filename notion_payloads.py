@@ -0,0 +1,159 @@
+import os
+import logging
+import metrics
+import log_setup
+import page_cache
+import http_client
+import poll_events
+from dotenv import load_dotenv
+from datetime import datetime, timezone
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# Notion lookups and page properties shared by the webhook app and the
+# reconcile job. Importing it starts nothing, unlike app.py.
+poll_result_dbid = os.getenv("POLL_RESULT_DB_ID")
+poll_det_result_dbid = os.getenv("POLL_DET_RESULT_DB_ID")
+
+
+def get_page_id(poll_result):
+    path = "/databases/{}/query".format(poll_result_dbid)
+    
+    poll_id = poll_result["poll"]["id"]
+    page_id = page_cache.get_poll_page(poll_id)
+    if page_id is not None:
+        return {"Status": "Success", "page_id": page_id}
+
+    data = get_poll_page_filter(poll_id)
+
+    try:
+        logging.info("Making the api call to find the entry that corresponds to the poll - %s", poll_id)
+        with metrics.stage("notion_query"):
+            resp = http_client.notion_request("POST", path, json=data)
+        resp_json = resp.json()
+        logging.info("Response from query database to get required page - %s", log_setup.payload(resp_json))
+        
+        if resp.status_code == 200:
+            if len(resp_json["results"]) > 1:
+                logging.error("Duplicate entries found in poll result db for poll id - %s.", poll_id)
+                return {"Status": "Failure"}
+            elif len(resp_json["results"]) == 0:
+                logging.error("No entry found for the required poll - %s", poll_id)
+                return {"Status": "Failure"}
+            else:
+                page_id = resp_json["results"][0]["id"]
+                page_cache.set_poll_page(poll_id, page_id)
+    except Exception as e:
+        logging.error("Unable to process the poll result to get correspdoning notion page ID. Error - %s", e)
+        return {"Status": "Failure"}
+
+    return {"Status": "Success", "page_id": page_id}
+
+
+def get_poll_page_filter(poll_id):
+    return {
+        "filter": {
+            "property": "Poll ID",
+            "title": {
+                "contains": poll_id
+            }
+        }
+    }
+
+
+def get_poll_result_properties(poll_result):
+    options = poll_result["poll"]["options"][:int(os.getenv("LOCATIONS_COUNT", "3"))]
+    status = "Closed" if poll_result["poll"]["is_closed"] else "Open"
+
+    properties = {"Kayo Event {}".format(i + 1): {"number": option["voter_count"]} for i, option in enumerate(options)}
+    properties["Status"] = {"select": {"name": status}}
+    return properties
+
+
+def get_user_vote_properties(poll_data):
+    poll_id = poll_data["poll_answer"]["poll_id"]
+    poll_date = datetime.now().astimezone(timezone.utc).today().date().isoformat()
+    userid = poll_data["poll_answer"]["user"]["id"]
+    username = poll_data["poll_answer"]["user"].get("username", "")
+    first_name = poll_data["poll_answer"]["user"].get("first_name", "")
+    last_name = poll_data["poll_answer"]["user"].get("last_name", "")
+    option_id_choice = poll_data["poll_answer"]["option_ids"][0]
+
+    event_name = os.getenv("EVENT_NAME")
+    with metrics.stage("events_lookup"):
+        events = poll_events.get_events(poll_id)
+    user_selection = (events or {}).get("{}{}".format(event_name, option_id_choice + 1))
+    if user_selection is None:
+        raise ValueError("No event found for option {} of poll {}".format(option_id_choice, poll_id))
+
+    data = {
+        "Poll ID": {"title": [{"text": {"content": poll_id}}]},
+        "Date": {"date": {"start": poll_date, "end": None}},
+        "UserID": {"number": userid},
+        "Username": {"rich_text": [{"text": {"content": username}}]},
+        "First Name": {"rich_text": [{"text": {"content": first_name}}]},
+        "Last Name": {"rich_text": [{"text": {"content": last_name}}]},
+        "Choice": {"rich_text": [{"text": {"content": user_selection}}]},
+    }
+    return data
+
+
+def get_user_page_id(poll_result):
+    path = "/databases/{}/query".format(poll_det_result_dbid)
+    
+    user_id = poll_result["poll_answer"]["user"]["id"]
+    poll_id = poll_result["poll_answer"]["poll_id"]
+    page_id = page_cache.get_vote_page(poll_id, user_id)
+    if page_id is not None:
+        return {"Status": "Success", "page_id": page_id}
+
+    data = get_user_page_filter(poll_id, user_id)
+
+    try:
+        logging.info("Making the api call to find the entry that correspondsing to the user - %s vote for poll - %s", user_id, poll_id)
+        with metrics.stage("notion_query"):
+            resp = http_client.notion_request("POST", path, json=data)
+        resp_json = resp.json()
+        logging.info("Response from query database to get required page - %s", log_setup.payload(resp_json))
+        
+        if resp.status_code == 200:
+            if len(resp_json["results"]) > 1:
+                logging.error("Duplicate entries found in poll result db for poll id - %s.", poll_id)
+                return {"Status": "Failure"}
+            elif len(resp_json["results"]) == 0:
+                logging.error("No entry found for the required poll - %s", poll_id)
+                return {"Status": "Failure"}
+            else:
+                page_id = resp_json["results"][0]["id"]
+                page_cache.set_vote_page(poll_id, user_id, page_id)
+        else:
+            return {"Status": "Failure"}
+    except Exception as e:
+        logging.error("Unable to find the page id of the user entry in db for user - %s. Error - %s", user_id, e)
+        return {"Status": "Failure"}
+
+    return {"Status": "Success", "page_id": page_id}
+
+
+def get_user_page_filter(poll_id, user_id):
+    return {
+        "filter":{
+        "and" : [{
+            "property": "UserID",
+            "number": {
+                "equals": user_id
+            }
+        },
+        {
+            "property": "Poll ID",
+            "title": {
+                "contains": poll_id
+            }
+        }]}
+    }
+
+
+def find_user_page_id(poll_id, user_id):
+    resp = get_user_page_id({"poll_answer": {"poll_id": poll_id, "user": {"id": user_id}}})
+    return resp.get("page_id")
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import logging
+import log_setup
+import argparse
+import threading
+import http_client
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+export_dir = os.getenv("NOTION_EXPORT_DIR") or os.path.join(cwd, "notion_export")
+sync_state_file = os.getenv("NOTION_SYNC_STATE_FILE") or os.path.join(cwd, "notion_sync_state.json")
+
+# Local name of each database and the env var holding its id
+databases = {
+    "poll_results": "POLL_RESULT_DB_ID",
+    "poll_votes": "POLL_DET_RESULT_DB_ID",
+    "poll_events": "POLL_TO_EVENT_DBID",
+}
+
+# Archived pages are never returned by a query, so an incremental export would
+# keep every vote that was retracted or archived by the reconcile since
+full_sync_databases = {"poll_votes"}
+
+_lock = threading.Lock()
+
+
+def _load_state():
+    try:
+        with open(sync_state_file) as infile:
+            return json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_state(state):
+    tmp_file = sync_state_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump(state, outfile)
+    os.replace(tmp_file, sync_state_file)
+
+
+def property_value(prop):
+    kind = prop.get("type")
+    value = prop.get(kind)
+    if kind in ("title", "rich_text"):
+        return "".join(part.get("plain_text") or part.get("text", {}).get("content", "") for part in value or [])
+    if kind in ("select", "status"):
+        return value["name"] if value else None
+    if kind == "multi_select":
+        return ",".join(option["name"] for option in value or [])
+    if kind == "date":
+        return value["start"] if value else None
+    if kind == "people":
+        return ",".join(person.get("name") or person["id"] for person in value or [])
+    if kind == "files":
+        return ",".join(item.get("name", "") for item in value or [])
+    if kind in ("formula", "rollup"):
+        return value.get(value.get("type")) if value else None
+    return value
+
+
+def flatten_page(page):
+    row = {
+        "page_id": page["id"],
+        "created_time": page.get("created_time"),
+        "last_edited_time": page.get("last_edited_time"),
+    }
+    for name, prop in page.get("properties", {}).items():
+        row[name] = property_value(prop)
+    return row
+
+
+def get_sync_filter(cursor):
+    payload = {"sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+    if cursor is not None:
+        # Notion compares at minute precision, so the boundary is read again and de-duplicated by page id
+        payload["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": cursor}}
+    return payload
+
+
+def sync_database(name, database_id, full=False):
+    import pandas as pd
+
+    full = full or name in full_sync_databases
+    with _lock:
+        cursor = None if full else _load_state().get(name)
+    export_file = os.path.join(export_dir, "{}.parquet".format(name))
+
+    rows = []
+    try:
+        for results in http_client.notion_query_pages(database_id, get_sync_filter(cursor)):
+            rows.extend(flatten_page(page) for page in results)
+    except Exception as e:
+        logging.error("Unable to sync notion database {}. Error - {}".format(name, e))
+        return {"Status": "Failure", "Database": name}
+    logging.info("Pulled {} changed pages from notion database {} since {}".format(len(rows), name, cursor))
+
+    if not rows and not full and os.path.exists(export_file):
+        return {"Status": "Success", "Database": name, "Changed": 0}
+
+    changed = pd.DataFrame(rows) if rows else pd.DataFrame(columns=["page_id", "created_time", "last_edited_time"])
+    if not full and os.path.exists(export_file):
+        existing = pd.read_parquet(export_file)
+        existing = existing[~existing["page_id"].isin(changed["page_id"])]
+        changed = pd.concat([existing, changed], ignore_index=True)
+    changed = changed.sort_values("last_edited_time", kind="stable").reset_index(drop=True)
+
+    os.makedirs(export_dir, exist_ok=True)
+    tmp_file = export_file + ".tmp"
+    changed.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, export_file)
+
+    if rows:
+        with _lock:
+            state = _load_state()
+            state[name] = max(row["last_edited_time"] for row in rows)
+            _save_state(state)
+    return {"Status": "Success", "Database": name, "Changed": len(rows), "Rows": len(changed)}
+
+
+def sync_all(names=None, full=False):
+    names = names or [name for name, env in databases.items() if os.getenv(env)]
+    with ThreadPoolExecutor(max_workers=len(names) or 1, thread_name_prefix="notion-sync") as executor:
+        results = list(executor.map(lambda name: sync_database(name, os.getenv(databases[name]), full), names))
+
+    status = "Success" if all(result["Status"] == "Success" for result in results) else "Failure"
+    return {"Status": status, "Results": results}
+
+
+def load_export(name):
+    import pandas as pd
+
+    return pd.read_parquet(os.path.join(export_dir, "{}.parquet".format(name)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sync the notion poll databases into local parquet files")
+    parser.add_argument("databases", nargs="*", help="Databases to sync ({}), all configured ones by default".format(", ".join(databases)))
+    parser.add_argument("--full", action="store_true", help="Ignore the saved cursors and export everything again, {} is always exported in full".format(", ".join(sorted(full_sync_databases))))
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.databases if name not in databases]
+    if unknown:
+        parser.error("unknown databases - {}".format(", ".join(unknown)))
+
+    log_setup.setup()
+    resp = sync_all(args.databases, args.full)
+    for result in resp["Results"]:
+        print("{:<14} {:<8} changed={} rows={}".format(result["Database"], result["Status"], result.get("Changed", "-"), result.get("Rows", "-")))
+    return 0 if resp["Status"] == "Success" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,136 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+ocr_backend = os.getenv("OCR_BACKEND", "vision")
+ocr_cache_file = os.getenv("OCR_CACHE_FILE") or os.path.join(cwd, "ocr_cache.json")
+# Margin in pixels kept around the region holding the location ids
+crop_margin = int(os.getenv("OCR_CROP_MARGIN", "20"))
+
+_lock = threading.Lock()
+_vision_client = None
+_cache = None
+
+
+def _vision_text(content, pattern):
+    global _vision_client
+    from google.cloud import vision
+    from google.cloud.vision_v1 import types
+
+    with _lock:
+        if _vision_client is None:
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(cwd, "cloud_vision_api.json")
+            _vision_client = vision.ImageAnnotatorClient()
+
+    response = _vision_client.text_detection(image=types.Image(content=content))
+    return response.text_annotations[0].description if response.text_annotations else ""
+
+
+def _binarize(content):
+    import cv2
+    import numpy as np
+
+    image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Unable to decode the image")
+    # Tesseract reads dark text on a light background best
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if np.mean(binary) < 127:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def _pattern_region(binary, pattern):
+    import pytesseract
+    from PIL import Image
+
+    # A quick pass over the whole image only to locate the words that look like location ids
+    words = pytesseract.image_to_data(Image.fromarray(binary), output_type=pytesseract.Output.DICT)
+    boxes = [
+        (words["left"][i], words["top"][i], words["left"][i] + words["width"][i], words["top"][i] + words["height"][i])
+        for i, word in enumerate(words["text"])
+        if word.strip() and re.search(pattern, word)
+    ]
+    if not boxes:
+        return None
+
+    height, width = binary.shape[:2]
+    left = max(0, min(box[0] for box in boxes) - crop_margin)
+    top = max(0, min(box[1] for box in boxes) - crop_margin)
+    right = min(width, max(box[2] for box in boxes) + crop_margin)
+    bottom = min(height, max(box[3] for box in boxes) + crop_margin)
+    return left, top, right, bottom
+
+
+def _tesseract_text(content, pattern):
+    import cv2
+    import pytesseract
+    from PIL import Image
+
+    binary = _binarize(content)
+    region = _pattern_region(binary, pattern) if pattern else None
+    if region is not None:
+        left, top, right, bottom = region
+        binary = binary[top:bottom, left:right]
+        # Small crops are upscaled, tesseract is most accurate around 30px high glyphs
+        binary = cv2.resize(binary, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    return pytesseract.image_to_string(Image.fromarray(binary))
+
+
+backends = {
+    "vision": _vision_text,
+    "tesseract": _tesseract_text,
+}
+
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(ocr_cache_file) as infile:
+                _cache = json.load(infile)
+        except (FileNotFoundError, ValueError):
+            _cache = {}
+    return _cache
+
+
+def _save_cache():
+    tmp_file = ocr_cache_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump(_cache, outfile)
+    os.replace(tmp_file, ocr_cache_file)
+
+
+def extract_text(content, pattern=None, backend=None, use_cache=True):
+    backend = backend or ocr_backend
+    # The pattern is part of the key because the local backend crops the image with it
+    key = "{}:{}:{}".format(backend, hashlib.sha256(content).hexdigest(), pattern or "")
+
+    if use_cache:
+        with _lock:
+            text = _load_cache().get(key)
+        if text is not None:
+            logging.info("Using the cached text of the image for the {} backend.".format(backend))
+            return text
+
+    text = backends[backend](content, pattern)
+
+    if use_cache:
+        with _lock:
+            _load_cache()[key] = text
+            try:
+                _save_cache()
+            except Exception as e:
+                logging.error("Unable to save the OCR cache. Error - {}".format(e))
+    return text
+
+
+def extract_location_ids(content, pattern, backend=None, use_cache=True):
+    return re.findall(pattern, extract_text(content, pattern, backend, use_cache))
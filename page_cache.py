@@ -0,0 +1,95 @@
+import os
+import sqlite3
+import logging
+import threading
+from cachetools import LRUCache
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# The memory cache sits in front of a small sqlite file so the page created by
+# send_poll.py (a different process) is visible to the webhook app.
+page_cache_db = os.getenv("PAGE_CACHE_DB") or os.path.join(cwd, "page_cache.db")
+page_cache_size = int(os.getenv("PAGE_CACHE_SIZE", "50000"))
+
+_local = threading.local()
+_lock = threading.Lock()
+_cache = LRUCache(maxsize=page_cache_size)
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(page_cache_db, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS poll_pages (poll_id TEXT PRIMARY KEY, page_id TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS vote_pages (poll_id TEXT NOT NULL, user_id INTEGER NOT NULL, page_id TEXT NOT NULL, PRIMARY KEY (poll_id, user_id))")
+        _local.conn = conn
+    return conn
+
+
+def _get(key, query, params):
+    with _lock:
+        page_id = _cache.get(key)
+    if page_id is not None:
+        return page_id
+
+    try:
+        row = _connection().execute(query, params).fetchone()
+    except Exception as e:
+        logging.error("Unable to read the page cache. Error - %s", e)
+        return None
+
+    if row is not None:
+        with _lock:
+            _cache[key] = row[0]
+        return row[0]
+    return None
+
+
+def _set(key, query, params):
+    with _lock:
+        _cache[key] = params[-1]
+    try:
+        _connection().execute(query, params)
+    except Exception as e:
+        logging.error("Unable to write the page cache. Error - %s", e)
+
+
+def get_poll_page(poll_id):
+    return _get(("poll", poll_id), "SELECT page_id FROM poll_pages WHERE poll_id = ?", (poll_id,))
+
+
+def set_poll_page(poll_id, page_id):
+    _set(("poll", poll_id), "INSERT OR REPLACE INTO poll_pages (poll_id, page_id) VALUES (?, ?)", (poll_id, page_id))
+
+
+def get_vote_page(poll_id, user_id):
+    return _get(("vote", poll_id, user_id), "SELECT page_id FROM vote_pages WHERE poll_id = ? AND user_id = ?", (poll_id, user_id))
+
+
+def set_vote_page(poll_id, user_id, page_id):
+    _set(("vote", poll_id, user_id), "INSERT OR REPLACE INTO vote_pages (poll_id, user_id, page_id) VALUES (?, ?, ?)", (poll_id, user_id, page_id))
+
+
+def remove_vote_page(poll_id, user_id):
+    with _lock:
+        _cache.pop(("vote", poll_id, user_id), None)
+    try:
+        _connection().execute("DELETE FROM vote_pages WHERE poll_id = ? AND user_id = ?", (poll_id, user_id))
+    except Exception as e:
+        logging.error("Unable to remove the vote page from the cache. Error - %s", e)
+
+
+def evict_poll(poll_id):
+    with _lock:
+        for key in [key for key in _cache.keys() if key[1] == poll_id]:
+            del _cache[key]
+    try:
+        conn = _connection()
+        conn.execute("DELETE FROM poll_pages WHERE poll_id = ?", (poll_id,))
+        conn.execute("DELETE FROM vote_pages WHERE poll_id = ?", (poll_id,))
+    except Exception as e:
+        logging.error("Unable to evict the poll %s from the page cache. Error - %s", poll_id, e)
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+pipeline_state_dir = os.getenv("PIPELINE_STATE_DIR") or os.path.join(cwd, "pipeline_state")
+
+
+# A stage is (function, [names of the stages it depends on]). The function gets
+# the results of its dependencies and returns a {"Status": ...} dict like the
+# rest of the project. Completed stages are saved after every step, so a
+# failed run started again with the same run id resumes from where it stopped.
+# A stage can also return {"Status": "Deferred", "run_at": <timestamp>} to stop
+# the run without failing it, so the caller can resume it at that time.
+# The result of a failed stage is kept as well and handed back to the stage
+# under "_previous" when the run resumes, so a stage that fans out can skip
+# the parts that already went through.
+def run_pipeline(run_id, stages, max_workers=4):
+    state_file = os.path.join(pipeline_state_dir, "{}.json".format(run_id))
+    state = _load_state(state_file)
+    results = state["results"]
+
+    for name, (_, deps) in stages.items():
+        for dep in deps:
+            if dep not in stages:
+                raise ValueError("Stage {} depends on unknown stage {}".format(name, dep))
+
+    done = {name for name in stages if name in results}
+    if done:
+        logging.info("Resuming pipeline {}. Already completed stages - {}".format(run_id, sorted(done)))
+
+    running = {}
+    failed = None
+    deferred = None
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline") as executor:
+        while True:
+            if failed is None and deferred is None:
+                for name, (func, deps) in stages.items():
+                    if name in done or name in running.values() or not all(dep in done for dep in deps):
+                        continue
+                    logging.info("Starting pipeline stage - {}".format(name))
+                    dep_results = {dep: results[dep] for dep in deps}
+                    if name in state["partial"]:
+                        dep_results["_previous"] = state["partial"][name]
+                    future = executor.submit(_run_stage, func, dep_results)
+                    running[future] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result, elapsed = future.result()
+                state["timings"][name] = elapsed
+                logging.info("Pipeline stage {} finished in {:.3f} seconds with status {}".format(name, elapsed, result.get("Status")))
+                if result.get("Status") == "Success":
+                    results[name] = result
+                    state["partial"].pop(name, None)
+                    done.add(name)
+                elif result.get("Status") == "Deferred":
+                    deferred = deferred or (name, result["run_at"])
+                else:
+                    state["partial"][name] = result
+                    failed = failed or name
+                _save_state(state_file, state)
+
+    if failed is not None:
+        logging.error("Pipeline {} stopped at stage {}. Run it again to resume from there.".format(run_id, failed))
+        return {"Status": "Failure", "Stage": failed, "Results": results, "Timings": state["timings"]}
+
+    if deferred is not None:
+        logging.info("Pipeline {} deferred at stage {} until {}".format(run_id, deferred[0], deferred[1]))
+        return {"Status": "Deferred", "Stage": deferred[0], "run_at": deferred[1], "Results": results, "Timings": state["timings"]}
+
+    missing = [name for name in stages if name not in done]
+    if missing:
+        return {"Status": "Failure", "Stage": missing[0], "Results": results, "Timings": state["timings"]}
+    return {"Status": "Success", "Results": results, "Timings": state["timings"]}
+
+
+def _run_stage(func, dep_results):
+    start = time.perf_counter()
+    try:
+        result = func(dep_results)
+    except Exception as e:
+        logging.error("Pipeline stage raised an error - {}".format(e))
+        result = {"Status": "Failure", "Error": str(e)}
+    if not isinstance(result, dict):
+        result = {"Status": "Failure", "Error": "Stage returned {}".format(result)}
+    return result, time.perf_counter() - start
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as infile:
+            state = json.load(infile)
+    except FileNotFoundError:
+        state = {"results": {}, "timings": {}}
+    state.setdefault("partial", {})
+    return state
+
+
+def _save_state(state_file, state):
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as outfile:
+        json.dump(state, outfile)
+    os.replace(tmp_file, state_file)
@@ -0,0 +1,104 @@
+import os
+import csv
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+events_file = os.path.join(cwd, "poll_to_events.csv")
+
+_lock = threading.Lock()
+_header = []
+_events = {}
+_offset = 0
+_inode = None
+
+
+def _parse(lines):
+    global _header
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if not _header:
+            _header = row
+            continue
+        names = _header[1:]
+        if len(row) > len(_header):
+            # Polls with more options than the header was written for
+            names = names + ["kayo_event_{}".format(i + 1) for i in range(len(names), len(row) - 1)]
+        _events[row[0]] = dict(zip(names, row[1:]))
+
+
+def _read_new_rows():
+    global _offset, _inode, _header
+    try:
+        stat = os.stat(events_file)
+    except FileNotFoundError:
+        return
+
+    # The file was replaced or truncated, so start again from the top
+    if stat.st_ino != _inode or stat.st_size < _offset:
+        _header, _offset, _inode = [], 0, stat.st_ino
+        _events.clear()
+
+    if stat.st_size == _offset:
+        return
+
+    with open(events_file, "rb") as infile:
+        infile.seek(_offset)
+        chunk = infile.read(stat.st_size - _offset)
+
+    # Only consume complete lines, a row that is still being written is picked up on the next refresh
+    end = chunk.rfind(b"\n") + 1
+    if end == 0:
+        if _header:
+            return
+        end = len(chunk)
+    _parse(chunk[:end].decode("utf-8").splitlines())
+    _offset += end
+
+
+def load():
+    with _lock:
+        _read_new_rows()
+    logging.info("Loaded %s polls from the poll to events file.", len(_events))
+
+
+def get_events(poll_id):
+    events = _events.get(poll_id)
+    if events is None:
+        # Another process (send_poll.py) may have added the poll since the last read
+        with _lock:
+            _read_new_rows()
+        events = _events.get(poll_id)
+    return events
+
+
+def all_events():
+    with _lock:
+        _read_new_rows()
+        return dict(_events)
+
+
+def add_poll(poll_id, location_ids):
+    add_polls([(poll_id, location_ids)])
+
+
+def add_polls(polls):
+    # All the polls of a fan-out run are appended in one write
+    if not polls:
+        return
+    with _lock:
+        with open(events_file, "a+", newline="") as outfile:
+            writer = csv.writer(outfile, lineterminator="\n")
+            outfile.seek(0, os.SEEK_END)
+            if outfile.tell() > 0:
+                outfile.seek(outfile.tell() - 1)
+                if outfile.read(1) != "\n":
+                    outfile.write("\n")
+            else:
+                writer.writerow(["poll_id"] + ["kayo_event_{}".format(i + 1) for i in range(max(len(location_ids) for _, location_ids in polls))])
+            writer.writerows([poll_id] + list(location_ids) for poll_id, location_ids in polls)
+        _read_new_rows()
@@ -1,6 +1,9 @@
 import os
 import json
-import requests
+import shutil
+import hashlib
+import image_cache
+import http_client
 import logging
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
@@ -10,27 +13,52 @@ cwd = os.getenv("PROJECT_DIR")
 
 #logging.basicConfig(filename='{}/app.log'.format(cwd), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-today = datetime.today()
-
 def fetch_image(image_url, image_loc, image_name):
+    today = datetime.today()
+    image_path = "{}{}.png".format(os.path.join(cwd, image_loc, image_name), today.strftime("%Y-%m-%d"))
+    # Notion hands out signed urls, the part before the query string identifies the file
+    cache_key = image_url.split("?")[0]
+    cached = image_cache.get_etag(cache_key)
+
+    headers = {}
+    if cached is not None and os.path.exists(cached["path"]):
+        headers["If-None-Match"] = cached["etag"]
+
     logging.info("Making the call to download the image.")
     try:
-        resp = requests.get(image_url, allow_redirects=True)
-        with open("{}{}.png".format(os.path.join(cwd, image_loc, image_name), today.strftime("%Y-%m-%d")), 'wb') as outfile:
-            outfile.write(resp.content)
+        resp = http_client.request("GET", image_url, endpoint="image download", allow_redirects=True, stream=True, headers=headers)
+        with resp:
+            if resp.status_code == 304:
+                logging.info("Image has not changed since the last download.")
+                if cached["path"] != image_path and not (os.path.exists(image_path) and image_cache.file_hash(image_path) == cached["hash"]):
+                    shutil.copyfile(cached["path"], image_path)
+                return {"Status": "Success", "Path": image_path, "Hash": cached["hash"]}
+            resp.raise_for_status()
+
+            digest = hashlib.sha256()
+            tmp_path = image_path + ".part"
+            with open(tmp_path, 'wb') as outfile:
+                for chunk in resp.iter_content(chunk_size=image_cache.chunk_size):
+                    digest.update(chunk)
+                    outfile.write(chunk)
+
+        content_hash = digest.hexdigest()
+        if os.path.exists(image_path) and image_cache.file_hash(image_path) == content_hash:
+            logging.info("Same image is already on disk. Keeping the existing file.")
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, image_path)
+
+        if resp.headers.get("ETag"):
+            image_cache.set_etag(cache_key, {"etag": resp.headers["ETag"], "path": image_path, "hash": content_hash})
     except Exception as e:
         logging.error("Unable to download the image. Error - {}".format(e))
         return {"Status": "Failure"}
-    return {"Status": "Success"}
+    return {"Status": "Success", "Path": image_path, "Hash": content_hash}
 
 
 def pull_data(database_id):
-    url = "https://api.notion.com/v1/databases/{}/query".format(database_id)
-    headers = {
-        "Authorization": "Bearer " + os.getenv("NOTION_TOKEN"),
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28"
-    }
+    today = datetime.today()
 
     payload = {
         "filter": {
@@ -43,21 +71,17 @@ def pull_data(database_id):
 
     logging.info("Making the api call to pull locations data from notion.")
     try:
-        resp = requests.post(url, json=payload, headers=headers)
-        logging.info("Response from the api call to pull locations db data - {}".format(resp.json()))
-        resp_json = resp.json()
-
-        if resp.status_code == 200:
-            if len(resp_json["results"]) > 1:
-                logging.error("Multiple location entries found in locations db for today.")
-                return {"Status": "Failure"}
-            elif len(resp_json["results"]) == 0:
-                logging.error("No entry found for the location of today in DB")
-                return {"Status": "Failure"}
-        else:
+        results = http_client.notion_query_all(database_id, payload)
+        logging.info("Response from the api call to pull locations db data - {}".format(results))
+
+        if len(results) > 1:
+            logging.error("Multiple location entries found in locations db for today.")
+            return {"Status": "Failure"}
+        elif len(results) == 0:
+            logging.error("No entry found for the location of today in DB")
             return {"Status": "Failure"}
 
-        image_url = resp_json["results"][0]["properties"]["Images"]["files"][0]["file"]["url"]
+        image_url = results[0]["properties"]["Images"]["files"][0]["file"]["url"]
     except Exception as e:
         logging.error("Unable to pull image data for today from locations DB. Error - {}".format(e))
         return {"Status": "Failure"}
@@ -0,0 +1,154 @@
+import os
+import logging
+import notion_payloads
+import metrics
+import log_setup
+import vote_store
+import page_cache
+import poll_events
+import http_client
+from notion_sync import property_value
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# Runs once a poll is closed. The final counts in notion are whichever result
+# update was written last, and the vote rows are whatever the writer managed to
+# send. Both are compared with telegram's final poll and the locally recorded
+# votes, and only the properties and rows that differ are written.
+event_name = os.getenv("EVENT_NAME")
+
+
+def aggregate_votes(poll_id):
+    counts, choices, users, unsynced = {}, {}, {}, set()
+    for user_id, option_ids, user, version, synced_version in vote_store.poll_votes(poll_id):
+        if synced_version < version:
+            unsynced.add(user_id)
+        if option_ids:
+            choices[user_id] = option_ids
+            users[user_id] = user
+            for option_id in option_ids:
+                counts[option_id] = counts.get(option_id, 0) + 1
+    return {"counts": counts, "choices": choices, "users": users, "unsynced": unsynced}
+
+
+def result_changes(poll, page_properties):
+    changes = {}
+    for name, value in notion_payloads.get_poll_result_properties({"poll": poll}).items():
+        current = property_value(page_properties[name]) if name in page_properties else None
+        wanted = value["number"] if "number" in value else value["select"]["name"]
+        if current != wanted:
+            changes[name] = value
+    return changes
+
+
+def get_vote_rows(poll_id):
+    # user id -> [(page id, choice)], more than one page for a user is a duplicate
+    rows = {}
+    for page in http_client.notion_query_all(notion_payloads.poll_det_result_dbid, notion_payloads.get_poll_page_filter(poll_id)):
+        properties = page["properties"]
+        # The filter matches on contains, so a longer poll id could come back too
+        if property_value(properties["Poll ID"]) != poll_id:
+            continue
+        rows.setdefault(property_value(properties["UserID"]), []).append((page["id"], property_value(properties["Choice"])))
+    return rows
+
+
+def vote_changes(local, rows, events):
+    creates, updates, archives = [], [], []
+    for user_id, pages in rows.items():
+        # The writer still owns votes that are not in notion yet
+        if user_id in local["unsynced"]:
+            continue
+        option_ids = local["choices"].get(user_id)
+        keep = None
+        if option_ids:
+            choice = events["{}{}".format(event_name, option_ids[0] + 1)]
+            keep = next((page for page in pages if page[1] == choice), pages[0])
+            if keep[1] != choice:
+                updates.append((keep[0], choice))
+        archives.extend(page_id for page_id, _ in pages if keep is None or page_id != keep[0])
+
+    creates = [user_id for user_id in local["choices"] if user_id not in rows and user_id not in local["unsynced"]]
+    return creates, updates, archives
+
+
+def _reconcile_result(poll):
+    # Returns the writes made to the result entry and how many of them failed
+    resp = notion_payloads.get_page_id({"poll": poll})
+    if resp["Status"] != "Success":
+        logging.error("Not able to find the corresponding entry for poll %s. Skipping the result counts.", poll["id"])
+        return 0, 1
+    try:
+        page = http_client.notion_request("GET", "/pages/{}".format(resp["page_id"]))
+        page_properties = page.json()["properties"] if page.status_code == 200 else {}
+    except Exception as e:
+        logging.error("Unable to read the result entry of poll %s. Error - %s", poll["id"], e)
+        page_properties = {}
+    changes = result_changes(poll, page_properties)
+    if not changes:
+        return 0, 0
+    logging.info("Correcting %s of the result entry of poll %s.", list(changes), poll["id"])
+    return 1, int(not _write("update result", "PATCH", "/pages/{}".format(resp["page_id"]), {"properties": changes}))
+
+
+def _write(kind, method, path, payload):
+    try:
+        resp = http_client.notion_request(method, path, json=payload)
+        logging.info("Response from the %s api call - %s", kind, log_setup.payload(resp.json))
+    except Exception as e:
+        logging.error("Unable to make the %s api call. Error - %s", kind, e)
+        return False
+    metrics.inc("pollbot_reconcile_writes_total", kind=kind)
+    return resp.status_code == 200
+
+
+def reconcile_poll(poll_id, poll=None):
+    with metrics.stage("reconcile"):
+        return _reconcile_poll(poll_id, poll)
+
+
+def _reconcile_poll(poll_id, poll):
+    local = aggregate_votes(poll_id)
+    writes, failed, drift = 0, 0, None
+    if poll is None:
+        logging.warning("No final poll from telegram for poll %s. Reconciling the vote entries only, the result counts are left as they are.", poll_id)
+    else:
+        counts = [option["voter_count"] for option in poll["options"]]
+        local_counts = [local["counts"].get(option_id, 0) for option_id in range(len(counts))]
+        drift = counts != local_counts
+        if drift:
+            logging.warning("Final counts of poll %s from telegram %s differ from the local votes %s.", poll_id, counts, local_counts)
+        # The final counts of the poll are the result, the snapshot is what historical queries read
+        vote_store.save_final_result(poll_id, poll["total_voter_count"], counts, local_counts, local["choices"])
+        writes, failed = _reconcile_result(poll)
+
+    events = poll_events.get_events(poll_id)
+    if not events:
+        logging.error("No events found for poll %s. Skipping the vote entries.", poll_id)
+        return {"Status": "Failure", "Writes": writes, "Failed": failed + 1}
+    try:
+        rows = get_vote_rows(poll_id)
+    except Exception as e:
+        logging.error("Unable to read the vote entries of poll %s. Error - %s", poll_id, e)
+        return {"Status": "Failure", "Writes": writes, "Failed": failed + 1}
+
+    creates, updates, archives = vote_changes(local, rows, events)
+    logging.info("Poll %s needs %s missing votes added, %s choices corrected and %s extra entries archived.", poll_id, len(creates), len(updates), len(archives))
+    for user_id in creates:
+        poll_data = {"poll_answer": {"poll_id": poll_id, "user": local["users"][user_id], "option_ids": local["choices"][user_id]}}
+        failed += not _write("insert user vote", "POST", "/pages", {"parent": {"database_id": notion_payloads.poll_det_result_dbid}, "properties": notion_payloads.get_user_vote_properties(poll_data)})
+    for page_id, choice in updates:
+        failed += not _write("update user vote", "PATCH", "/pages/{}".format(page_id), {"properties": {"Choice": {"rich_text": [{"text": {"content": choice}}]}}})
+    for page_id in archives:
+        failed += not _write("archive user vote", "PATCH", "/pages/{}".format(page_id), {"archived": True})
+    writes += len(creates) + len(updates) + len(archives)
+    page_cache.evict_poll(poll_id)
+
+    result = {"Status": "Success", "Writes": writes, "Failed": failed, "Drift": drift, "Unsynced": len(local["unsynced"])}
+    # Failed writes and votes the writer has not sent yet are checked again when the job is retried
+    if failed or local["unsynced"]:
+        result["Status"] = "Failure"
+    logging.info("Reconciled poll %s - %s", poll_id, result)
+    return result
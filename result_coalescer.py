@@ -0,0 +1,99 @@
+import os
+import atexit
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+flush_interval = float(os.getenv("RESULT_FLUSH_INTERVAL", "5"))
+max_flush_attempts = int(os.getenv("RESULT_FLUSH_ATTEMPTS", "5"))
+
+_lock = threading.Lock()
+# Held for the whole pop + write so an older snapshot can never land after a newer one
+_flush_lock = threading.Lock()
+_stop = threading.Event()
+_pending = {}
+_closed_polls = set()
+_flusher = None
+_handler = None
+
+
+def start(flush_handler):
+    global _flusher, _handler
+    with _lock:
+        if _flusher is not None:
+            return
+        _handler = flush_handler
+        _stop.clear()
+        _flusher = threading.Thread(target=_run, name="result-coalescer", daemon=True)
+        _flusher.start()
+    atexit.register(flush_all)
+    logging.info("Started the poll result coalescer with a flush interval of %s seconds.", flush_interval)
+
+
+def stop():
+    global _flusher
+    _stop.set()
+    if _flusher is not None:
+        _flusher.join()
+        _flusher = None
+    flush_all()
+
+
+def submit(poll_result):
+    poll_id = poll_result["poll"]["id"]
+
+    if poll_result["poll"]["is_closed"] or flush_interval <= 0:
+        with _flush_lock:
+            with _lock:
+                _pending.pop(poll_id, None)
+                if poll_result["poll"]["is_closed"]:
+                    _closed_polls.add(poll_id)
+            _write(poll_id, poll_result, 0)
+        return
+
+    with _lock:
+        if poll_id in _closed_polls:
+            logging.info("Poll %s is already closed. Ignoring the late result update.", poll_id)
+            return
+        _pending[poll_id] = (poll_result, 0)
+
+
+def pending_count():
+    with _lock:
+        return len(_pending)
+
+
+def _write(poll_id, poll_result, attempts):
+    try:
+        resp = _handler(poll_result)
+    except Exception as e:
+        logging.error("Unable to flush the results of poll %s. Error - %s", poll_id, e)
+        resp = "Not Ok"
+    # A handler may also hand back the failed response itself
+    if getattr(resp, "status_code", 200) >= 300:
+        resp = "Not Ok"
+
+    if resp == "Not Ok":
+        if attempts + 1 >= max_flush_attempts:
+            logging.error("Giving up on the results of poll %s after %s attempts.", poll_id, attempts + 1)
+            return
+        with _lock:
+            # Keep a newer snapshot if one came in while this one was being written
+            if poll_id not in _closed_polls or poll_result["poll"]["is_closed"]:
+                _pending.setdefault(poll_id, (poll_result, attempts + 1))
+
+
+def flush_all():
+    with _flush_lock:
+        with _lock:
+            snapshots = list(_pending.items())
+            _pending.clear()
+        for poll_id, (poll_result, attempts) in snapshots:
+            _write(poll_id, poll_result, attempts)
+
+
+def _run():
+    while not _stop.wait(flush_interval):
+        flush_all()
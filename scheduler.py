@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import log_setup
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+scheduler_db = os.getenv("SCHEDULER_DB") or os.path.join(cwd, "scheduler.db")
+poll_interval = float(os.getenv("SCHEDULER_POLL_INTERVAL", "5"))
+worker_count = int(os.getenv("SCHEDULER_WORKERS", "8"))
+max_attempts = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "5"))
+
+_local = threading.local()
+_stop = threading.Event()
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(scheduler_db, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                run_at REAL NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                dedup_key TEXT UNIQUE
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)")
+        _local.conn = conn
+    return conn
+
+
+def add_job(kind, run_at, payload, dedup_key=None):
+    # dedup_key makes adding the same job twice (e.g. a resumed send run) a no-op
+    cursor = _connection().execute(
+        "INSERT OR IGNORE INTO jobs (kind, run_at, payload, created_at, dedup_key) VALUES (?, ?, ?, ?, ?)",
+        (kind, run_at, json.dumps(payload), time.time(), dedup_key)
+    )
+    logging.info("Scheduled {} job at {} with payload - {}".format(kind, datetime.fromtimestamp(run_at), payload))
+    return cursor.lastrowid
+
+
+def list_jobs(status=None):
+    query = "SELECT id, kind, run_at, payload, status, attempts, last_error FROM jobs"
+    params = ()
+    if status is not None:
+        query += " WHERE status = ?"
+        params = (status,)
+    return _connection().execute(query + " ORDER BY run_at", params).fetchall()
+
+
+def _claim_due_jobs(now):
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        jobs = conn.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status = 'pending' AND run_at <= ? ORDER BY run_at", (now,)).fetchall()
+        conn.executemany("UPDATE jobs SET status = 'running' WHERE id = ?", [(job[0],) for job in jobs])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return jobs
+
+
+def _finish_job(job_id, attempts, result):
+    conn = _connection()
+    if result.get("Status") == "Success":
+        conn.execute("UPDATE jobs SET status = 'done', last_error = NULL WHERE id = ?", (job_id,))
+    elif result.get("Status") == "Deferred":
+        conn.execute("UPDATE jobs SET status = 'pending', run_at = ? WHERE id = ?", (result["run_at"], job_id))
+    elif attempts + 1 >= max_attempts:
+        logging.error("Job {} failed {} times. Giving up on it.".format(job_id, attempts + 1))
+        conn.execute("UPDATE jobs SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?", (json.dumps(result), job_id))
+    else:
+        retry_at = time.time() + min(60 * 2 ** attempts, 3600)
+        conn.execute("UPDATE jobs SET status = 'pending', attempts = attempts + 1, run_at = ?, last_error = ? WHERE id = ?", (retry_at, json.dumps(result), job_id))
+
+
+def run_send_job(payload):
+    import send_poll
+
+    if payload.get("daily"):
+        # Added before the run, so a day that fails does not end the schedule. Retries
+        # and deferred runs of the same day find it there already.
+        next_run = datetime.fromtimestamp(payload["first_run_at"])
+        while next_run.timestamp() <= time.time():
+            next_run += timedelta(days=1)
+        add_job("send", next_run.timestamp(), payload, "send:{}".format(next_run.strftime("%Y-%m-%d %H:%M")))
+    return send_poll.main(blocking_wait=False)
+
+
+def finalize_stopped_poll(resp, message_id, poll_id=None):
+    # Queues the reconcile of a poll stopPoll closed or found closed already.
+    # Returns whether the poll is closed now.
+    if resp["Status"] == "Success":
+        poll = resp["Response"]["result"]
+        add_job("finalize", time.time(), {"poll": poll}, "finalize:{}".format(poll["id"]))
+        return True
+
+    description = (resp.get("Response") or {}).get("description", "")
+    if "already been closed" not in description:
+        return False
+    logging.info("Poll with message id {} was already closed.".format(message_id))
+    # E.g. a retried stopPoll whose first attempt went through, the result is still owed a reconcile
+    if poll_id:
+        add_job("finalize", time.time(), {"poll_id": poll_id}, "finalize:{}".format(poll_id))
+    else:
+        logging.error("No poll id known for message id {}. The final result is not reconciled.".format(message_id))
+    return True
+
+
+def run_stop_job(payload):
+    from stop_poll import stop_poll
+
+    resp = stop_poll(os.getenv("API_KEY"), payload["chat_id"], payload["message_id"])
+    if finalize_stopped_poll(resp, payload["message_id"], payload.get("poll_id")):
+        return {"Status": "Success"}
+    return resp
+
+
+def run_finalize_job(payload):
+    # Writes telegram's final counts and fixes vote entries that drifted from the local votes
+    import reconcile
+    import vote_store
+
+    # Without the poll from stopPoll, the closed poll telegram sent with the results
+    if "poll" in payload:
+        return reconcile.reconcile_poll(payload["poll"]["id"], payload["poll"])
+    return reconcile.reconcile_poll(payload["poll_id"], vote_store.get_closed_poll(payload["poll_id"]))
+
+
+handlers = {
+    "send": run_send_job,
+    "stop": run_stop_job,
+    "finalize": run_finalize_job,
+}
+
+
+def _run_job(job):
+    job_id, kind, payload, attempts = job
+    try:
+        result = handlers[kind](json.loads(payload))
+    except Exception as e:
+        logging.error("Job {} of kind {} raised an error - {}".format(job_id, kind, e))
+        result = {"Status": "Failure", "Error": str(e)}
+    _finish_job(job_id, attempts, result)
+
+
+def run_forever():
+    # Jobs left running by a crashed scheduler are picked up again, and jobs whose
+    # time passed while it was down are due immediately
+    recovered = _connection().execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+    if recovered:
+        logging.info("Recovered {} jobs that were running when the scheduler stopped.".format(recovered))
+
+    logging.info("Scheduler started with {} workers.".format(worker_count))
+    with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="scheduler") as executor:
+        while not _stop.is_set():
+            jobs = _claim_due_jobs(time.time())
+            if jobs:
+                # Everything due in this tick (e.g. a batch of stopPoll calls) goes out together
+                logging.info("Running {} due jobs - {}".format(len(jobs), [job[1] for job in jobs]))
+                for job in jobs:
+                    executor.submit(_run_job, job)
+
+            next_run = _connection().execute("SELECT MIN(run_at) FROM jobs WHERE status = 'pending'").fetchone()[0]
+            delay = poll_interval if next_run is None else min(poll_interval, max(0, next_run - time.time()))
+            _stop.wait(delay)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Persistent scheduler for sending and stopping polls")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="Run the scheduler loop")
+
+    add_send = subparsers.add_parser("add-send", help="Schedule the daily poll run")
+    add_send.add_argument("at", help="Time of the first run, e.g. 2023-02-08T09:00")
+    add_send.add_argument("--daily", action="store_true", help="Schedule it again every day at the same time")
+
+    add_stop = subparsers.add_parser("add-stop", help="Schedule closing a poll")
+    add_stop.add_argument("message_id", type=int)
+    add_stop.add_argument("at", help="Time to close the poll, e.g. 2023-02-08T21:00")
+    add_stop.add_argument("--chat-id", default=os.getenv("CHANNEL_ID"))
+    add_stop.add_argument("--poll-id", help="Telegram id of the poll, lets the result be reconciled if the poll was closed already")
+
+    list_parser = subparsers.add_parser("list", help="List scheduled jobs")
+    list_parser.add_argument("--status")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "add-send":
+        run_at = datetime.fromisoformat(args.at).timestamp()
+        add_job("send", run_at, {"daily": args.daily, "first_run_at": run_at}, "send:{}".format(datetime.fromtimestamp(run_at).strftime("%Y-%m-%d %H:%M")))
+    elif args.command == "add-stop":
+        add_job("stop", datetime.fromisoformat(args.at).timestamp(), {"chat_id": args.chat_id, "message_id": args.message_id, "poll_id": args.poll_id}, "stop:{}:{}".format(args.chat_id, args.message_id))
+    elif args.command == "list":
+        for job_id, kind, run_at, payload, status, attempts, last_error in list_jobs(args.status):
+            print("{:>6} {:<9} {:<20} {:<8} {:>2} {} {}".format(job_id, kind, datetime.fromtimestamp(run_at).strftime("%Y-%m-%d %H:%M:%S"), status, attempts, payload, last_error or ""))
+    else:
+        log_setup.setup()
+        run_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,30 +1,62 @@
 #!/bin/sh
 
 import os
-import io
 import json
-import requests
+import http_client
 import logging
-import re
+import log_setup
 import time
-from google.cloud import vision
-from google.cloud.vision_v1 import types
-import pandas as pd
+import ocr
+import image_cache
+import page_cache
+import poll_events
+import scheduler
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import run_pipeline
 from pull_data import initiate_data_pull
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 
 load_dotenv()
 cwd = os.getenv("PROJECT_DIR")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(cwd, "cloud_vision_api.json")
 
-logging.basicConfig(filename='{}/app.log'.format(cwd), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+log_setup.setup()
 
 today = datetime.today()
+fan_out_workers = int(os.getenv("FAN_OUT_WORKERS", "8"))
+
+
+def get_channel_ids():
+    channel_ids = os.getenv("CHANNEL_IDS") or os.getenv("CHANNEL_ID") or ""
+    return [channel_id.strip() for channel_id in channel_ids.split(",") if channel_id.strip()]
+
+
+def fan_out(func, keys, previous=None):
+    # Runs func(key) for all keys concurrently, the telegram and notion rate limits
+    # in http_client keep the calls within the api limits. Keys that succeeded in a
+    # previous attempt are not run again.
+    previous = (previous or {}).get("Results", {})
+    results = {key: previous[key] for key in keys if previous.get(key, {}).get("Status") == "Success"}
+    pending = [key for key in keys if key not in results]
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(fan_out_workers, len(pending)), thread_name_prefix="fan-out") as executor:
+            results.update(zip(pending, executor.map(func, pending)))
+
+    failed = [key for key in keys if results[key].get("Status") != "Success"]
+    if failed:
+        logging.error("Fan out failed for {} of {} - {}".format(len(failed), len(keys), failed))
+    return {"Status": "Failure" if failed else "Success", "Results": results, "Failed": failed}
+
+
+def fan_out_image(send, channel_ids, previous=None):
+    # The first channel uploads the image, the others reuse the telegram file id it returned
+    first = fan_out(send, channel_ids[:1], previous)
+    # Channels that got the image before a resume keep their result
+    results = dict((previous or {}).get("Results", {}), **first["Results"])
+    return fan_out(send, channel_ids, {"Results": results})
 
-def send_location_img(image, caption, bot_token, channel_id):
-    url = "https://api.telegram.org/bot{}/sendPhoto".format(bot_token)
 
+def send_location_img(image, caption, bot_token, channel_id):
     resp = {}
     params = {
         "chat_id": channel_id,
@@ -32,29 +64,39 @@ def send_location_img(image, caption, bot_token, channel_id):
     }
 
     try:
-        with open(image, 'rb') as infile:
-            image_binary = infile.read()
-
-        response = requests.post(url, params=params, files={"photo": image_binary})
-        logging.info("Response from send image api call - {}".format(response.json()))
+        image_data = image_cache.read_image(image)
+        file_id = image_cache.get_file_id(image_data["hash"])
+
+        response = None
+        if file_id is not None:
+            # Telegram already has these bytes, send the reference instead of uploading again
+            logging.info("Sending the image using the cached telegram file id.")
+            response = http_client.telegram_request("POST", "sendPhoto", bot_token, params=dict(params, photo=file_id))
+            if response.status_code != 200:
+                logging.error("Cached file id was rejected - {}. Uploading the image instead.".format(response.json()))
+                response = None
+
+        if response is None:
+            response = http_client.telegram_request("POST", "sendPhoto", bot_token, params=params, files={"photo": image_data["content"]})
+        response_json = response.json()
+        logging.info("Response from send image api call - {}".format(response_json))
+
+        if response.status_code == 200:
+            image_cache.set_file_id(image_data["hash"], response_json["result"]["photo"][-1]["file_id"])
     except Exception as e:
         logging.error("Unable to send image to the chat. Error - {}".format(e))
         resp["Status"] = "Failure"
+        return resp
 
     resp["Status"] = "Success" if response.status_code == 200 else "Failure"
     return resp
     
 
 def process_img(img, pattern):
+    location_ids = []
     try:
         logging.info("Trying to process image and extract text information.")
-        client = vision.ImageAnnotatorClient()
-        with io.open(img, 'rb') as image_file:
-            content = image_file.read()
-        image = types.Image(content=content)
-        response = client.text_detection(image=image)
-        text = response.text_annotations[0].description
-        location_ids = re.findall(pattern, text)
+        location_ids = ocr.extract_location_ids(image_cache.read_image(img)["content"], pattern)
         logging.info("Found the location ids - {}".format(location_ids))
     except Exception as e:
         logging.error("Unable to process image. Error - {}".format(e))
@@ -62,17 +104,9 @@ def process_img(img, pattern):
 
 
 def register_poll(poll_data, notion_token, db_id):
-    url = "https://api.notion.com/v1/pages"
-
     poll_id = poll_data["result"]["poll"]["id"]
     poll_date = datetime.now().astimezone(timezone.utc).today().date().isoformat()
 
-    headers = {
-        "Authorization": "Bearer " + notion_token,
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28"
-    }
-
     data = {
         "Poll ID": {"title": [{"text": {"content": poll_id}}]},
         "Poll Date": {"date": {"start": poll_date, "end": None}},
@@ -87,30 +121,29 @@ def register_poll(poll_data, notion_token, db_id):
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        logging.info("Registering the poll in notion. Response from the api call - {}".format(response.json()))
+        response = http_client.notion_request("POST", "/pages", notion_token, json=payload)
+        response_json = response.json()
+        logging.info("Registering the poll in notion. Response from the api call - {}".format(response_json))
+
+        if response.status_code != 200:
+            return {"Status": "Failure"}
+        page_cache.set_poll_page(poll_id, response_json["id"])
     except Exception as e:
         logging.error("Unable to register the poll. Error - {}".format(e))
         return {"Status": "Failure"}
     return {"Status": "Success"}
 
-def register_events(poll_data, notion_token, location_ids, db_id):
-    url = "https://api.notion.com/v1/pages"
+def register_polls(poll_datas, notion_token, db_id, previous=None):
+    # poll_datas maps each channel to its sendPoll response
+    return fan_out(lambda channel_id: register_poll(poll_datas[channel_id], notion_token, db_id), list(poll_datas), previous)
 
-    poll_id = poll_data["result"]["poll"]["id"]
 
-    headers = {
-        "Authorization": "Bearer " + notion_token,
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28"
-    }
+def register_events(poll_data, notion_token, location_ids, db_id, save_locally=True):
+    poll_id = poll_data["result"]["poll"]["id"]
 
-    data = {
-        "Poll ID": {"title": [{"text": {"content": poll_id}}]},
-        "Kayo Event 1": {"rich_text": [{"text": {"content": location_ids[0]}}]},
-        "Kayo Event 2": {"rich_text": [{"text": {"content": location_ids[1]}}]},
-        "Kayo Event 3": {"rich_text": [{"text": {"content": location_ids[2]}}]},
-    }
+    data = {"Poll ID": {"title": [{"text": {"content": poll_id}}]}}
+    for i, location_id in enumerate(location_ids):
+        data["Kayo Event {}".format(i + 1)] = {"rich_text": [{"text": {"content": location_id}}]}
 
     payload = {
         "parent": {
@@ -120,103 +153,185 @@ def register_events(poll_data, notion_token, location_ids, db_id):
     }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        logging.info("Registered the poll events in notion. Response from the api call - {}".format(response.json()))    
-
-        logging.info("Saving the location ids in the file...")
-        poll_to_event_df = pd.read_csv(os.path.join(cwd, "poll_to_events.csv"), dtype=str)
-        poll_to_event_df.loc[len(poll_to_event_df.index)] = [poll_id, location_ids[0], location_ids[1], location_ids[2]]
-        poll_to_event_df.to_csv(os.path.join(cwd, "poll_to_events.csv"), index=False)
+        # Saved locally first, the webhook app needs it to resolve votes even if notion is unavailable
+        if save_locally:
+            logging.info("Saving the location ids in the file...")
+            poll_events.add_poll(poll_id, location_ids)
+
+        response = http_client.notion_request("POST", "/pages", notion_token, json=payload)
+        logging.info("Registered the poll events in notion. Response from the api call - {}".format(response.json()))
+        if response.status_code != 200:
+            return {"Status": "Failure"}
     except Exception as e:
         logging.error("Unable to register the poll events in notion or save in file. Error - {}".format(e))
         return {"Status": "Failure"}
     return {"Status": "Success"}
 
 
-def send_poll(bot_token, channel_id, location_ids, poll_q, notion_token, poll_results_dbid, poll_to_event_dbid):
+def register_events_bulk(poll_datas, notion_token, location_ids, db_id, previous=None):
+    done = (previous or {}).get("Results", {})
+    pending = [channel_id for channel_id in poll_datas if done.get(channel_id, {}).get("Status") != "Success"]
+    try:
+        logging.info("Saving the location ids of {} polls in the file...".format(len(pending)))
+        poll_events.add_polls([(poll_datas[channel_id]["result"]["poll"]["id"], location_ids) for channel_id in pending])
+    except Exception as e:
+        logging.error("Unable to save the poll events in file. Error - {}".format(e))
+        return {"Status": "Failure"}
+
+    return fan_out(lambda channel_id: register_events(poll_datas[channel_id], notion_token, location_ids, db_id, save_locally=False), list(poll_datas), previous)
+
+
+def get_poll_params(channel_id, poll_q):
     poll_options_user = os.getenv("POLL_OPTIONS_USER")
-    
-    url = "https://api.telegram.org/bot{}/sendPoll".format(bot_token)
 
-    params = {
+    return {
         "chat_id": channel_id,
         "question": poll_q,
         "options": json.dumps(poll_options_user.split("*")),
         "is_anonymous": False
     }
 
+
+def send_poll(bot_token, channel_id, location_ids, poll_q, notion_token, poll_results_dbid, poll_to_event_dbid, params=None, register=True):
+    params = params or get_poll_params(channel_id, poll_q)
+
     try:
         logging.info("Making the api call to send the poll in the chat.")
-        resp = requests.get(url, data=params)
+        resp = http_client.telegram_request("POST", "sendPoll", bot_token, data=params)
         json_resp = resp.json()
         logging.info("Response from send poll api call - {}".format(json_resp))
 
-        if resp.status_code == 200:
+        if resp.status_code != 200:
+            return {"Status": "Failure"}
+
+        if register:
             logging.info("Calling method to register the poll and events in notion DB.")
             register_poll(json_resp, notion_token, poll_results_dbid)
             register_events(json_resp, notion_token, location_ids, poll_to_event_dbid)
-        else:
-            return {"Status": "Failure"}
 
     except Exception as e:
         logging.error("Unable to send the poll in the chat. Error - {}".format(e))
         return {"Status": "Failure"}
 
     return {"Status": "Success", "Response": json_resp}
-    
 
-def main():
+
+def schedule_poll_stop(message_id, channel_id, poll_duration, started_at, poll_id=None):
+    d, h, m = poll_duration.split("-")
+    poll_end_date = datetime.fromtimestamp(started_at) + timedelta(days=int(d), hours=int(h), minutes=int(m))
+
+    # The scheduler process (scheduler.py run) closes the poll at that time
+    try:
+        scheduler.add_job("stop", poll_end_date.timestamp(), {"chat_id": channel_id, "message_id": message_id, "poll_id": poll_id}, "stop:{}:{}".format(channel_id, message_id))
+    except Exception as e:
+        logging.error("Unable to schedule the poll stop. Error - {}".format(e))
+        return {"Status": "Failure"}
+    return {"Status": "Success", "run_at": poll_end_date.timestamp()}
+
+
+def main(blocking_wait=True):
+    global today
+    today = datetime.today()
+
     img_name, img_loc = os.getenv("IMAGE_NAME"), os.getenv("IMAGE_LOCATION")
     locations_count, pattern = os.getenv("LOCATIONS_COUNT"), os.getenv("PATTERN")
     caption, poll_q = os.getenv("IMAGE_CAPTION"), os.getenv("POLL_Q")
-    bot_token, channel_id = os.getenv("API_KEY"), os.getenv("CHANNEL_ID")
+    bot_token, channel_ids = os.getenv("API_KEY"), get_channel_ids()
     wait_time, poll_duration = os.getenv("WAIT_TIME"), os.getenv("POLL_DURATION")
-    venv, code_loc = os.getenv("VENV"), os.getenv("STOP_POLL_CODE")
     poll_results_dbid, notion_token, poll_to_event_dbid = os.getenv("POLL_RESULT_DB_ID"), os.getenv("NOTION_TOKEN"), os.getenv("POLL_TO_EVENT_DBID")
 
-
-    data_pull_resp = initiate_data_pull()
-    logging.info("Response from initiate pull method - {}".format(data_pull_resp))
-    if data_pull_resp["Status"] != "Success":
-        return data_pull_resp
+    if not channel_ids:
+        logging.error("No channel to send the poll to. Set CHANNEL_IDS or CHANNEL_ID. Exiting the flow....")
+        return {"Status": "Failure", "Stage": "channels"}
 
     image = "{}{}.png".format(os.path.join(cwd, img_loc, img_name), today.strftime("%Y-%m-%d"))
-
-    if (not os.path.exists(image)) or (data_pull_resp["Status"] != "Success"):
-        logging.error("Image file not found. Exiting the flow....")
-        return {"Status": "Failure"}
-    
-    location_ids = process_img(image, pattern)
-
-    if len(location_ids) != int(locations_count):
-        logging.error("Required locations count is not same as the ones we received. Exiting the flow....")
-        return {"Status": "Failure"}
-
-    img_send_result = send_location_img(image, caption, bot_token, channel_id)
-
-    if img_send_result["Status"] != "Success":
-        logging.error("Bot was unable to send the image. Exiting the flow....")
-        return
-
     hh, mm, ss = wait_time.split("-")
-    time.sleep(int(hh) * 3600 + int(mm) * 60 + int(ss))
 
-    send_poll_resp = send_poll(bot_token, channel_id, location_ids, poll_q, notion_token, poll_results_dbid, poll_to_event_dbid)
+    def pull_image(results):
+        started_at = time.time()
+        data_pull_resp = initiate_data_pull()
+        logging.info("Response from initiate pull method - {}".format(data_pull_resp))
+        if data_pull_resp["Status"] == "Success" and not os.path.exists(image):
+            logging.error("Image file not found. Exiting the flow....")
+            return {"Status": "Failure"}
+        data_pull_resp["started_at"] = started_at
+        return data_pull_resp
 
-    if send_poll_resp["Status"] != "Success":
-        logging.error("Unable to send the poll, Exiting the flow.")
-        return
-    
-    message_id = send_poll_resp["Response"]["result"]["message_id"]
-    d, h, m = poll_duration.split("-")
-    poll_end_date = today + timedelta(days=int(d), hours=int(h), minutes=int(m))
+    def extract_locations(results):
+        location_ids = process_img(image, pattern)
+        if len(location_ids) != int(locations_count):
+            logging.error("Required locations count is not same as the ones we received. Exiting the flow....")
+            return {"Status": "Failure"}
+        return {"Status": "Success", "location_ids": location_ids}
+
+    def send_image(results):
+        def send(channel_id):
+            img_send_result = send_location_img(image, caption, bot_token, channel_id)
+            img_send_result["sent_at"] = time.time()
+            return img_send_result
+
+        img_send_result = fan_out_image(send, channel_ids, results.get("_previous"))
+        if img_send_result["Status"] != "Success":
+            logging.error("Bot was unable to send the image. Exiting the flow....")
+        img_send_result["sent_at"] = max(result.get("sent_at", 0) for result in img_send_result["Results"].values())
+        return img_send_result
+
+    def wait_for_poll(results):
+        # Measured from when the image went out, so a resumed run does not wait twice
+        poll_at = results["send_image"]["sent_at"] + int(hh) * 3600 + int(mm) * 60 + int(ss)
+        if poll_at > time.time() and not blocking_wait:
+            # Under the scheduler the run is picked up again at poll_at instead of holding a thread
+            return {"Status": "Deferred", "run_at": poll_at}
+        if poll_at > time.time():
+            time.sleep(poll_at - time.time())
+        return {"Status": "Success"}
+
+    def prepare_poll(results):
+        return {"Status": "Success", "params": get_poll_params(None, poll_q)}
+
+    def post_poll(results):
+        params = results["prepare_poll"]["params"]
+        send_poll_resp = fan_out(
+            lambda channel_id: send_poll(bot_token, channel_id, None, poll_q, notion_token, poll_results_dbid, poll_to_event_dbid, params=dict(params, chat_id=channel_id), register=False),
+            channel_ids, results.get("_previous")
+        )
+        if send_poll_resp["Status"] != "Success":
+            logging.error("Unable to send the poll, Exiting the flow.")
+        return send_poll_resp
+
+    def sent_polls(results):
+        return {channel_id: result["Response"] for channel_id, result in results["post_poll"]["Results"].items()}
+
+    def register_poll_result(results):
+        return register_polls(sent_polls(results), notion_token, poll_results_dbid, results.get("_previous"))
+
+    def register_poll_events(results):
+        return register_events_bulk(sent_polls(results), notion_token, results["extract_locations"]["location_ids"], poll_to_event_dbid, results.get("_previous"))
+
+    def schedule_stop(results):
+        polls = sent_polls(results)
+        return fan_out(
+            lambda channel_id: schedule_poll_stop(polls[channel_id]["result"]["message_id"], channel_id, poll_duration, results["pull_image"]["started_at"], polls[channel_id]["result"]["poll"]["id"]),
+            list(polls), results.get("_previous")
+        )
+
+    stages = {
+        "pull_image": (pull_image, []),
+        "extract_locations": (extract_locations, ["pull_image"]),
+        "send_image": (send_image, ["extract_locations"]),
+        "wait_for_poll": (wait_for_poll, ["send_image"]),
+        "prepare_poll": (prepare_poll, ["extract_locations"]),
+        "post_poll": (post_poll, ["wait_for_poll", "prepare_poll"]),
+        "register_poll": (register_poll_result, ["post_poll"]),
+        "register_events": (register_poll_events, ["post_poll", "extract_locations"]),
+        "schedule_stop": (schedule_stop, ["post_poll", "pull_image"]),
+    }
 
-    logging.info("Project Dir - {}, POll Stop Code - {}".format(cwd, code_loc))
+    pipeline_resp = run_pipeline("send_poll_{}".format(today.strftime("%Y-%m-%d")), stages)
+    logging.info("Pipeline stage timings - {}".format(pipeline_resp["Timings"]))
+    logging.info("Outbound api call metrics - {}".format(http_client.get_metrics()))
+    return pipeline_resp
 
-    # Schedule to end the poll
-    sch_resp = os.system('echo "{} {} {}" | at {}'.format(venv, os.path.join(cwd, code_loc), message_id, poll_end_date.strftime("%I:%M %p %d.%m.%Y")))
-    logging.info("Scheduling response - {}".format(sch_resp))
-    
 
 if __name__=="__main__":
     main()
@@ -2,37 +2,42 @@
 
 import os
 import sys
-import requests
+import http_client
 import logging
+import log_setup
+import scheduler
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 
 load_dotenv()
 cwd = os.getenv("PROJECT_DIR")
 
-logging.basicConfig(filename='{}/app.log'.format(cwd), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+log_setup.setup()
 
 def stop_poll(bot_token, channel_id, msg_id):
-    url = "https://api.telegram.org/bot{}/stopPoll".format(bot_token)
-
     data = {
         "chat_id": channel_id,
         "message_id": msg_id,
         "reply_markup": {}
     }
     try:
-        response = requests.post(url, json=data)
-        logging.info("Response from stop poll api call - {}".format(response.json()))
+        response = http_client.telegram_request("POST", "stopPoll", bot_token, json=data, idempotent=True)
+        response_json = response.json()
+        logging.info("Response from stop poll api call - {}".format(response_json))
     except Exception as e:
         logging.error("Unable to stop the poll. Error - {}".format(e))
         return {"Status": "Failure"}
-    return {"Status": "Success"}
+    if response.status_code != 200:
+        return {"Status": "Failure", "Response": response_json}
+    return {"Status": "Success", "Response": response_json}
 
-def main(message_id):
+def main(message_id, poll_id=None):
     bot_token, channel_id = os.getenv("API_KEY"), os.getenv("CHANNEL_ID")
 
     logging.info("Stopping the poll with message id - {}".format(message_id))
-    stop_poll(bot_token, channel_id, message_id)
+    resp = stop_poll(bot_token, channel_id, message_id)
+    scheduler.finalize_stopped_poll(resp, message_id, poll_id)
+    logging.info("Outbound api call metrics - {}".format(http_client.get_metrics()))
 
 if __name__=="__main__":
-    main(sys.argv[1])
\ No newline at end of file
+    main(*sys.argv[1:3])
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The modules read PROJECT_DIR when they are imported, so it points at a scratch directory first
+os.environ["PROJECT_DIR"] = tempfile.mkdtemp(prefix="pollbot_tests_")
+os.environ.setdefault("LOG_DIR", os.environ["PROJECT_DIR"])
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
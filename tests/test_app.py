@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+import app
+import vote_store
+import vote_writer
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(vote_store, "vote_store_db", str(tmp_path / "votes.db"))
+    monkeypatch.setattr(vote_store, "_local", threading.local())
+    monkeypatch.setattr(vote_writer, "_pending", {})
+
+
+def answer(poll_id, option_ids):
+    return {"update_id": 10, "poll_answer": {"poll_id": poll_id, "user": {"id": 1}, "option_ids": option_ids}}
+
+
+def test_answer_to_an_unknown_poll_is_not_recorded(monkeypatch):
+    monkeypatch.setattr(app.poll_events, "get_events", lambda poll_id: None)
+
+    for _ in range(3):
+        with pytest.raises(ValueError, match="unknown-poll"):
+            app.process_update(answer("unknown-poll", [0]))
+
+    assert list(vote_store.read_vote_log()) == []
+    assert vote_writer.pending_count() == 0
+
+
+def test_retried_answer_is_logged_once(monkeypatch):
+    monkeypatch.setenv("EVENT_NAME", "kayo_event_")
+    monkeypatch.setattr(app.poll_events, "get_events", lambda poll_id: {"kayo_event_1": "event-1"})
+
+    app.process_update(answer("poll", [0]))
+    app.process_update(answer("poll", [0]))
+
+    assert len(list(vote_store.read_vote_log())) == 1
+    assert vote_writer._pending[("poll", 1)]["version"] == 1
+
+
+def test_closed_poll_is_kept_for_the_reconcile(monkeypatch):
+    monkeypatch.setattr(app.result_coalescer, "submit", lambda data: None)
+    poll = {"id": "poll", "is_closed": False, "total_voter_count": 1, "options": [{"text": "a", "voter_count": 1}]}
+
+    app.process_update({"update_id": 1, "poll": poll})
+    assert vote_store.get_closed_poll("poll") is None
+
+    app.process_update({"update_id": 2, "poll": dict(poll, is_closed=True)})
+    assert vote_store.get_closed_poll("poll") == dict(poll, is_closed=True)
+
+
+@pytest.mark.parametrize("path", ["/queue", "/http-metrics"])
+def test_operational_endpoints_are_only_served_locally(path):
+    client = app.app.test_client()
+
+    assert client.get(path, environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code == 403
+    assert client.get(path, environ_base={"REMOTE_ADDR": "127.0.0.1"}).status_code == 200
+
+
+def test_profiling_is_only_switched_by_a_post(monkeypatch):
+    monkeypatch.setattr(app.metrics, "_profiling", False)
+    client = app.app.test_client()
+
+    assert client.get("/profiling?enabled=1").get_json()["enabled"] is False
+    assert client.post("/profiling?enabled=1").get_json()["enabled"] is True
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+import pytest
+import dedup
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch, tmp_path):
+    monkeypatch.setattr(dedup, "dedup_state_file", str(tmp_path / "dedup_state.json"))
+    monkeypatch.setattr(dedup, "_updates", OrderedDict())
+    monkeypatch.setattr(dedup, "_answers", OrderedDict())
+    monkeypatch.setattr(dedup, "_low_watermark", None)
+    monkeypatch.setattr(dedup, "_last_save", 0.0)
+    monkeypatch.setattr(dedup, "_dirty", False)
+    monkeypatch.setattr(dedup, "_loaded", False)
+
+
+def answer(update_id, option_ids, user_id=1):
+    return {"update_id": update_id, "poll_answer": {"poll_id": "poll", "user": {"id": user_id}, "option_ids": option_ids}}
+
+
+def test_replayed_update_id_is_dropped():
+    assert dedup.accept(answer(1, [0])) is not None
+    assert dedup.accept(answer(1, [0])) is None
+
+
+def test_repeated_answer_with_a_new_update_id_is_dropped():
+    assert dedup.accept(answer(1, [0])) is not None
+    assert dedup.accept(answer(2, [0])) is None
+    assert dedup.accept(answer(3, [1])) is not None
+    assert dedup.accept(answer(4, [0])) is not None
+
+
+def test_release_lets_the_update_in_again():
+    dedup.accept(answer(1, [0]))
+    token = dedup.accept(answer(2, [1]))
+
+    dedup.release(token)
+
+    assert dedup.accept(answer(2, [1])) is not None
+    # The answer before the released one is back as the user's last answer
+    dedup.release(dedup.accept(answer(3, [2])))
+    assert dedup.accept(answer(4, [1])) is None
+
+
+def test_release_of_a_first_answer_forgets_the_user():
+    token = dedup.accept(answer(1, [0]))
+
+    dedup.release(token)
+
+    assert dedup.stats()["answers"] == 0
+    assert dedup.accept(answer(2, [0])) is not None
+
+
+def test_watermark_survives_a_restart(monkeypatch):
+    monkeypatch.setattr(dedup, "persist_count", 2)
+    for update_id in (10, 11, 12):
+        dedup.accept(answer(update_id, [0], user_id=update_id))
+    dedup.flush()
+
+    # A new process starts with empty memory and loads the saved state
+    monkeypatch.setattr(dedup, "_updates", OrderedDict())
+    monkeypatch.setattr(dedup, "_answers", OrderedDict())
+    monkeypatch.setattr(dedup, "_low_watermark", None)
+    monkeypatch.setattr(dedup, "_loaded", False)
+
+    assert dedup.accept(answer(10, [1], user_id=10)) is None
+    assert dedup.accept(answer(12, [1], user_id=12)) is None
+    assert dedup.accept(answer(13, [1], user_id=13)) is not None
+    assert dedup.stats()["low_watermark"] == 11
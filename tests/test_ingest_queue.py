@@ -0,0 +1,66 @@
+import time
+import threading
+
+import pytest
+import ingest_queue
+
+
+@pytest.fixture(autouse=True)
+def queue(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest_queue, "queue_db", str(tmp_path / "ingest_queue.db"))
+    monkeypatch.setattr(ingest_queue, "_local", threading.local())
+    monkeypatch.setattr(ingest_queue, "_depth", None)
+    monkeypatch.setattr(ingest_queue, "_workers", [])
+    monkeypatch.setattr(ingest_queue, "worker_count", 2)
+    yield
+    ingest_queue.stop_workers(timeout=5)
+
+
+def run_workers(count):
+    handled = []
+    ingest_queue.start_workers(lambda update: handled.append(update["n"]))
+    deadline = time.time() + 5
+    while len(handled) < count and time.time() < deadline:
+        time.sleep(0.01)
+    ingest_queue.stop_workers(timeout=5)
+    return handled
+
+
+def test_later_update_waits_for_a_claimed_one():
+    ingest_queue.enqueue({"n": 1}, "poll:1")
+    ingest_queue.enqueue({"n": 2}, "poll:1")
+    worker_index = next(i for i in range(ingest_queue.worker_count) if ingest_queue._claim(i) is not None)
+
+    assert ingest_queue._claim(worker_index) is None
+
+
+def test_order_is_kept_after_a_restart():
+    ingest_queue.enqueue({"n": 1}, "poll:1")
+    ingest_queue.enqueue({"n": 2}, "poll:1")
+    ingest_queue.enqueue({"n": 3}, "poll:1")
+    # The previous process claimed the first update and stopped before acking it
+    for worker_index in range(ingest_queue.worker_count):
+        ingest_queue._claim(worker_index)
+
+    assert run_workers(3) == [1, 2, 3]
+    assert ingest_queue.queue_stats()["depth"] == 0
+
+
+def test_failed_update_is_retried_before_the_next_one():
+    ingest_queue.enqueue({"n": 1}, "poll:1")
+    ingest_queue.enqueue({"n": 2}, "poll:1")
+    handled, failures = [], [1]
+
+    def handler(update):
+        if update["n"] in failures:
+            failures.remove(update["n"])
+            raise ValueError("notion is down")
+        handled.append(update["n"])
+
+    ingest_queue.start_workers(handler)
+    deadline = time.time() + 5
+    while len(handled) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    ingest_queue.stop_workers(timeout=5)
+
+    assert handled == [1, 2]
@@ -0,0 +1,66 @@
+import json
+import threading
+from collections import OrderedDict
+
+import pytest
+import app
+import dedup
+import long_poll
+import ingest_queue
+
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest_queue, "queue_db", str(tmp_path / "ingest_queue.db"))
+    monkeypatch.setattr(ingest_queue, "_local", threading.local())
+    monkeypatch.setattr(ingest_queue, "_depth", None)
+    monkeypatch.setattr(dedup, "dedup_state_file", str(tmp_path / "dedup_state.json"))
+    monkeypatch.setattr(dedup, "_updates", OrderedDict())
+    monkeypatch.setattr(dedup, "_answers", OrderedDict())
+    monkeypatch.setattr(dedup, "_low_watermark", None)
+    monkeypatch.setattr(dedup, "_loaded", True)
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    applied = []
+
+    def process_update(update):
+        # The poll is not registered yet, so its votes cannot be recorded
+        if update["poll_answer"]["poll_id"] == "unknown":
+            raise ValueError("No events found for poll")
+        applied.append(update["update_id"])
+    monkeypatch.setattr(app, "process_update", process_update)
+    return applied
+
+
+def answer(update_id, option_ids, poll_id="unknown", user_id=1):
+    return {"update_id": update_id, "poll_answer": {"poll_id": poll_id, "user": {"id": user_id}, "option_ids": option_ids}}
+
+
+def queued():
+    rows = ingest_queue._connection().execute("SELECT payload FROM updates ORDER BY id").fetchall()
+    return [json.loads(payload)["update_id"] for payload, in rows]
+
+
+def test_retraction_waits_behind_a_failed_vote(processed):
+    taken, offset = long_poll.dispatch([answer(1, [0]), answer(2, []), answer(3, [1], poll_id="known")])
+
+    assert taken == 3
+    assert offset == 4
+    assert processed == [3]
+    assert queued() == [1, 2]
+
+
+def test_full_queue_keeps_the_offset_at_the_first_update_left_out(monkeypatch, processed):
+    monkeypatch.setattr(ingest_queue, "max_depth", 0)
+
+    taken, offset = long_poll.dispatch([answer(1, [0]), answer(2, []), answer(3, [1], poll_id="known")])
+
+    assert (taken, offset) == (0, 1)
+    assert processed == []
+    assert queued() == []
+    # The updates come back with the next getUpdates and are not taken for replays
+    assert dedup.accept(answer(1, [0])) is not None
+    assert dedup.accept(answer(2, [])) is not None
+    assert dedup.accept(answer(3, [1], poll_id="known")) is not None
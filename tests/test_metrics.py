@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+import metrics
+import ip_allowlist
+
+
+@pytest.fixture
+def local_proxy(monkeypatch):
+    monkeypatch.setattr(ip_allowlist, "trusted_proxies", ip_allowlist.compile_ranges(["127.0.0.1/32"]))
+
+
+def test_direct_loopback_client_is_local():
+    assert metrics.is_local("127.0.0.1")
+    assert metrics.is_local("::1")
+    assert not metrics.is_local("149.154.167.220")
+
+
+def test_client_behind_a_trusted_local_proxy_is_not_local(local_proxy):
+    assert not metrics.is_local("127.0.0.1", "203.0.113.7")
+    assert metrics.is_local("127.0.0.1", "127.0.0.1")
+
+
+def test_forwarded_request_through_an_untrusted_local_proxy_is_not_local():
+    assert not metrics.is_local("127.0.0.1", "203.0.113.7")
+    assert not metrics.is_local("127.0.0.1", "not-an-address")
+
+
+def test_sampler_does_not_hold_the_metrics_lock(monkeypatch):
+    monkeypatch.setattr(metrics, "_profiling", True)
+    folding = threading.Event()
+    release = threading.Event()
+
+    def slow_fold(frame):
+        folding.set()
+        release.wait(5)
+        return "stack"
+    monkeypatch.setattr(metrics, "_fold", slow_fold)
+
+    with metrics.profile_request("test"):
+        assert folding.wait(5)
+        # A counter is not held up by a sample in progress
+        assert metrics._lock.acquire(timeout=1)
+        metrics._lock.release()
+        release.set()
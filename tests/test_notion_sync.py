@@ -0,0 +1,46 @@
+import pytest
+import notion_sync
+
+
+@pytest.fixture(autouse=True)
+def export(monkeypatch, tmp_path):
+    monkeypatch.setattr(notion_sync, "export_dir", str(tmp_path / "export"))
+    monkeypatch.setattr(notion_sync, "sync_state_file", str(tmp_path / "notion_sync_state.json"))
+
+
+def page(page_id, edited, **properties):
+    return {"id": page_id, "last_edited_time": edited, "properties": {name: {"type": "number", "number": value} for name, value in properties.items()}}
+
+
+def serve(monkeypatch, pages):
+    payloads = []
+
+    def notion_query_pages(database_id, payload):
+        payloads.append(payload)
+        yield pages
+    monkeypatch.setattr(notion_sync.http_client, "notion_query_pages", notion_query_pages)
+    return payloads
+
+
+def test_archived_votes_leave_the_export(monkeypatch):
+    serve(monkeypatch, [page("a", "2026-01-01T10:00", UserID=1), page("b", "2026-01-01T10:01", UserID=2)])
+    notion_sync.sync_database("poll_votes", "db")
+
+    # Page b was archived, the query does not return it anymore
+    payloads = serve(monkeypatch, [page("a", "2026-01-01T10:00", UserID=1)])
+    result = notion_sync.sync_database("poll_votes", "db")
+
+    assert "filter" not in payloads[0]
+    assert result["Rows"] == 1
+    assert list(notion_sync.load_export("poll_votes")["page_id"]) == ["a"]
+
+
+def test_other_databases_are_synced_from_the_cursor(monkeypatch):
+    serve(monkeypatch, [page("a", "2026-01-01T10:00", Count=1)])
+    notion_sync.sync_database("poll_results", "db")
+
+    payloads = serve(monkeypatch, [page("b", "2026-01-01T10:05", Count=2)])
+    result = notion_sync.sync_database("poll_results", "db")
+
+    assert payloads[0]["filter"]["last_edited_time"] == {"on_or_after": "2026-01-01T10:00"}
+    assert result["Rows"] == 2
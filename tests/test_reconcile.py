@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+import reconcile
+import vote_store
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(vote_store, "vote_store_db", str(tmp_path / "votes.db"))
+    monkeypatch.setattr(vote_store, "_local", threading.local())
+    monkeypatch.setattr(reconcile, "event_name", "kayo_event_")
+    monkeypatch.setenv("LOCATIONS_COUNT", "3")
+
+
+events = {"kayo_event_1": "event-1", "kayo_event_2": "event-2"}
+
+
+def number(value):
+    return {"type": "number", "number": value}
+
+
+def test_result_changes_only_has_the_properties_that_differ():
+    poll = {"id": "poll", "is_closed": True, "options": [{"voter_count": 2}, {"voter_count": 1}, {"voter_count": 0}]}
+    page_properties = {
+        "Kayo Event 1": number(2),
+        "Kayo Event 2": number(3),
+        "Status": {"type": "select", "select": {"name": "Open"}},
+    }
+
+    assert reconcile.result_changes(poll, page_properties) == {
+        "Kayo Event 2": {"number": 1},
+        "Kayo Event 3": {"number": 0},
+        "Status": {"select": {"name": "Closed"}},
+    }
+
+
+def test_vote_changes():
+    local = {"choices": {1: [0], 2: [1], 4: [0], 6: [1]}, "unsynced": {5}}
+    rows = {
+        1: [("page-1", "event-1")],
+        # A duplicate, the entry with the right choice is kept
+        2: [("page-2", "event-1"), ("page-3", "event-2")],
+        # Retracted
+        3: [("page-4", "event-1")],
+        # Still owned by the writer
+        5: [("page-5", "event-2")],
+        6: [("page-6", "event-1")],
+    }
+
+    creates, updates, archives = reconcile.vote_changes(local, rows, events)
+
+    assert creates == [4]
+    assert updates == [("page-6", "event-2")]
+    assert archives == ["page-2", "page-4"]
+
+
+def test_without_a_final_poll_only_the_vote_entries_are_reconciled(monkeypatch):
+    requests = []
+    monkeypatch.setattr(reconcile.http_client, "notion_request", lambda method, path, **kwargs: requests.append((method, path)))
+    monkeypatch.setattr(reconcile.poll_events, "get_events", lambda poll_id: events)
+    monkeypatch.setattr(reconcile, "get_vote_rows", lambda poll_id: {1: [("page-1", "event-1")]})
+    vote_store.record_vote("poll", {"id": 1}, [0])
+    vote_store.mark_synced("poll", 1, 1)
+
+    result = reconcile.reconcile_poll("poll")
+
+    assert result == {"Status": "Success", "Writes": 0, "Failed": 0, "Drift": None, "Unsynced": 0}
+    assert requests == []
+    assert vote_store.get_final_result("poll") is None
@@ -0,0 +1,80 @@
+import sys
+import json
+import types
+import threading
+
+import pytest
+import scheduler
+import vote_store
+
+
+@pytest.fixture(autouse=True)
+def db(monkeypatch, tmp_path):
+    monkeypatch.setattr(scheduler, "scheduler_db", str(tmp_path / "scheduler.db"))
+    monkeypatch.setattr(scheduler, "_local", threading.local())
+    monkeypatch.setattr(vote_store, "vote_store_db", str(tmp_path / "votes.db"))
+    monkeypatch.setattr(vote_store, "_local", threading.local())
+
+
+def stop_poll_returning(monkeypatch, resp):
+    monkeypatch.setitem(sys.modules, "stop_poll", types.SimpleNamespace(stop_poll=lambda bot_token, chat_id, message_id: resp))
+
+
+def finalize_jobs():
+    return [json.loads(job[3]) for job in scheduler.list_jobs() if job[1] == "finalize"]
+
+
+def test_stop_of_a_closed_poll_still_queues_the_reconcile(monkeypatch):
+    stop_poll_returning(monkeypatch, {"Status": "Failure", "Response": {"ok": False, "description": "Bad Request: poll has already been closed"}})
+
+    assert scheduler.run_stop_job({"chat_id": "chat", "message_id": 5, "poll_id": "poll"}) == {"Status": "Success"}
+    assert finalize_jobs() == [{"poll_id": "poll"}]
+
+
+def test_stopped_poll_queues_the_reconcile_with_telegrams_poll(monkeypatch):
+    poll = {"id": "poll", "is_closed": True, "total_voter_count": 1, "options": [{"text": "a", "voter_count": 1}]}
+    stop_poll_returning(monkeypatch, {"Status": "Success", "Response": {"ok": True, "result": poll}})
+
+    scheduler.run_stop_job({"chat_id": "chat", "message_id": 5, "poll_id": "poll"})
+    # A retried stop that finds the poll closed does not add a second one
+    stop_poll_returning(monkeypatch, {"Status": "Failure", "Response": {"ok": False, "description": "Bad Request: poll has already been closed"}})
+    scheduler.run_stop_job({"chat_id": "chat", "message_id": 5, "poll_id": "poll"})
+
+    assert finalize_jobs() == [{"poll": poll}]
+
+
+def reconciled_polls(monkeypatch):
+    import reconcile
+
+    reconciled = []
+    monkeypatch.setattr(reconcile, "reconcile_poll", lambda poll_id, poll=None: reconciled.append((poll_id, poll)) or {"Status": "Success"})
+    return reconciled
+
+
+def test_finalize_without_stop_polls_poll_uses_the_closed_poll_telegram_sent(monkeypatch):
+    reconciled = reconciled_polls(monkeypatch)
+    poll = {"id": "poll", "is_closed": True, "total_voter_count": 2, "options": [{"text": "a", "voter_count": 2}]}
+    vote_store.save_closed_poll(poll)
+
+    scheduler.run_finalize_job({"poll_id": "poll"})
+
+    assert reconciled == [("poll", poll)]
+
+
+def test_finalize_without_any_final_poll_leaves_the_counts_alone(monkeypatch):
+    reconciled = reconciled_polls(monkeypatch)
+    vote_store.record_vote("poll", {"id": 1}, [1])
+
+    scheduler.run_finalize_job({"poll_id": "poll"})
+
+    assert reconciled == [("poll", None)]
+
+
+def test_cli_stop_queues_the_reconcile(monkeypatch):
+    import cli
+
+    poll = {"id": "poll", "is_closed": True, "total_voter_count": 0, "options": []}
+    stop_poll_returning(monkeypatch, {"Status": "Success", "Response": {"ok": True, "result": poll}})
+
+    assert cli.main(["stop", "5", "--chat-id", "chat"]) == 0
+    assert finalize_jobs() == [{"poll": poll}]
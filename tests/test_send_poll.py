@@ -0,0 +1,48 @@
+import send_poll
+
+
+def sender(calls, failing=()):
+    def send(channel_id):
+        calls.append(channel_id)
+        return {"Status": "Failure" if channel_id in failing else "Success", "sent_at": 1}
+    return send
+
+
+def test_resumed_image_fan_out_only_sends_to_the_channels_that_failed():
+    calls = []
+    previous = {"Status": "Failure", "Results": {"A": {"Status": "Success"}, "B": {"Status": "Success"}, "C": {"Status": "Failure"}}, "Failed": ["C"]}
+
+    result = send_poll.fan_out_image(sender(calls), ["A", "B", "C"], previous)
+
+    assert calls == ["C"]
+    assert result["Status"] == "Success"
+    assert result["Results"]["B"] == {"Status": "Success"}
+
+
+def test_resume_uploads_on_the_first_channel_before_the_others():
+    calls = []
+    previous = {"Status": "Failure", "Results": {"A": {"Status": "Failure"}, "B": {"Status": "Success"}}, "Failed": ["A"]}
+
+    result = send_poll.fan_out_image(sender(calls), ["A", "B", "C"], previous)
+
+    assert calls == ["A", "C"]
+    assert result["Failed"] == []
+
+
+def test_failed_channel_is_reported():
+    result = send_poll.fan_out_image(sender([], failing=("B",)), ["A", "B"])
+
+    assert result["Status"] == "Failure"
+    assert result["Failed"] == ["B"]
+
+
+def test_run_without_channels_fails_up_front(monkeypatch):
+    monkeypatch.delenv("CHANNEL_IDS", raising=False)
+    monkeypatch.delenv("CHANNEL_ID", raising=False)
+    monkeypatch.setattr(send_poll, "run_pipeline", lambda *args: pytest_fail())
+
+    assert send_poll.main(blocking_wait=False) == {"Status": "Failure", "Stage": "channels"}
+
+
+def pytest_fail():
+    raise AssertionError("the pipeline must not run")
@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+
+import pytest
+import vote_store
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch, tmp_path):
+    monkeypatch.setattr(vote_store, "vote_store_db", str(tmp_path / "votes.db"))
+    monkeypatch.setattr(vote_store, "_local", threading.local())
+
+
+def log_rows():
+    return list(vote_store.read_vote_log())
+
+
+def test_retried_update_is_recorded_once():
+    first = vote_store.record_vote("poll", {"id": 1}, [0], update_id=10)
+    retry = vote_store.record_vote("poll", {"id": 1}, [0], update_id=10)
+
+    assert first == retry == (None, 1)
+    assert len(log_rows()) == 1
+    assert vote_store.get_tallies("poll") == {0: 1}
+
+
+def test_retried_retraction_returns_the_options_it_retracted():
+    vote_store.record_vote("poll", {"id": 1}, [2], update_id=10)
+    first = vote_store.record_vote("poll", {"id": 1}, [], update_id=11)
+    retry = vote_store.record_vote("poll", {"id": 1}, [], update_id=11)
+
+    assert first == retry == ([2], 2)
+    assert len(log_rows()) == 2
+
+
+def test_new_update_with_the_same_options_is_recorded():
+    vote_store.record_vote("poll", {"id": 1}, [0], update_id=10)
+
+    assert vote_store.record_vote("poll", {"id": 1}, [0], update_id=11) == ([0], 2)
+    assert len(log_rows()) == 2
+
+
+def test_store_without_update_ids_is_migrated(tmp_path):
+    conn = sqlite3.connect(vote_store.vote_store_db)
+    conn.execute(
+        "CREATE TABLE votes (poll_id TEXT NOT NULL, user_id INTEGER NOT NULL, option_ids TEXT NOT NULL, user TEXT NOT NULL, "
+        "version INTEGER NOT NULL, synced_version INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL, PRIMARY KEY (poll_id, user_id))"
+    )
+    conn.execute("INSERT INTO votes VALUES ('poll', 1, '[0]', '{\"id\": 1}', 1, 1, 0)")
+    conn.commit()
+    conn.close()
+
+    assert vote_store.record_vote("poll", {"id": 1}, [1], update_id=10) == ([0], 2)
+    assert vote_store.record_vote("poll", {"id": 1}, [1], update_id=10) == ([0], 2)
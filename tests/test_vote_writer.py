@@ -0,0 +1,86 @@
+import pytest
+import vote_writer
+
+
+@pytest.fixture(autouse=True)
+def writer(monkeypatch):
+    synced = []
+    monkeypatch.setattr(vote_writer, "_pending", {})
+    monkeypatch.setattr(vote_writer, "_executor", None)
+    monkeypatch.setattr(vote_writer, "_on_synced", lambda poll_id, user_id, version: synced.append((poll_id, user_id, version)))
+    return synced
+
+
+def test_vote_then_retraction_in_one_window_cancel_out(writer):
+    vote_writer.submit_vote("poll", 1, {"Choice": "a"}, 1)
+    vote_writer.submit_retraction("poll", 1, 2)
+
+    assert vote_writer.pending_count() == 0
+    assert writer == [("poll", 1, 2)]
+
+
+def test_vote_retraction_vote_in_one_window_keeps_the_last_vote():
+    vote_writer.submit_vote("poll", 1, {"Choice": "a"}, 1)
+    vote_writer.submit_retraction("poll", 1, 2)
+    vote_writer.submit_vote("poll", 1, {"Choice": "b"}, 3)
+
+    assert vote_writer._pending[("poll", 1)] == {"insert": {"Choice": "b"}, "archive": False, "attempts": 0, "version": 3}
+
+
+def test_retraction_of_a_written_vote_archives_it():
+    vote_writer.submit_retraction("poll", 1, 2)
+
+    assert vote_writer._pending[("poll", 1)]["archive"] is True
+    assert vote_writer._pending[("poll", 1)]["insert"] is None
+
+
+def test_vote_retraction_vote_across_windows_rewrites_the_existing_page(monkeypatch, writer):
+    calls = []
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {"id": "new-page"}
+
+    def notion_request(method, path, **kwargs):
+        calls.append((method, path, kwargs.get("json")))
+        return Response()
+
+    monkeypatch.setattr(vote_writer.http_client, "notion_request", notion_request)
+    monkeypatch.setattr(vote_writer, "_lookup_page_id", lambda poll_id, user_id: "page-1")
+
+    # The first vote was written in an earlier window, the page exists in notion
+    vote_writer.submit_retraction("poll", 1, 2)
+    vote_writer.submit_vote("poll", 1, {"Choice": "b"}, 3)
+    vote_writer.flush_all()
+
+    assert calls == [("PATCH", "/pages/page-1", {"properties": {"Choice": "b"}})]
+    assert writer == [("poll", 1, 3)]
+    assert vote_writer.pending_count() == 0
+
+
+def test_failed_write_is_requeued(monkeypatch):
+    monkeypatch.setattr(vote_writer, "_write", lambda key, state: False)
+    vote_writer.submit_vote("poll", 1, {"Choice": "a"}, 1)
+    vote_writer.flush_all()
+
+    assert vote_writer._pending[("poll", 1)]["attempts"] == 1
+    assert vote_writer._pending[("poll", 1)]["insert"] == {"Choice": "a"}
+
+
+def test_requeue_keeps_the_newer_state_and_the_owed_archive():
+    vote_writer.submit_vote("poll", 1, {"Choice": "b"}, 3)
+    failed = {"insert": None, "archive": True, "attempts": 0, "version": 2}
+
+    vote_writer._requeue(("poll", 1), failed)
+
+    assert vote_writer._pending[("poll", 1)] == {"insert": {"Choice": "b"}, "archive": True, "attempts": 0, "version": 3}
+
+
+def test_requeue_gives_up_after_the_last_attempt():
+    state = {"insert": {"Choice": "a"}, "archive": False, "attempts": vote_writer.max_write_attempts - 1, "version": 1}
+
+    vote_writer._requeue(("poll", 1), state)
+
+    assert vote_writer.pending_count() == 0
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+cwd = os.getenv("PROJECT_DIR")
+
+# Local system of record for who voted for what. Notion is written from here
+# asynchronously and rows stay unsynced until the Notion write went through.
+vote_store_db = os.getenv("VOTE_STORE_DB") or os.path.join(cwd, "votes.db")
+
+_local = threading.local()
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(vote_store_db, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS votes (
+                poll_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                option_ids TEXT NOT NULL,
+                user TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                synced_version INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                update_id INTEGER,
+                previous_option_ids TEXT,
+                PRIMARY KEY (poll_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS votes_unsynced ON votes (synced_version, version);
+            CREATE TABLE IF NOT EXISTS tallies (
+                poll_id TEXT NOT NULL,
+                option_id INTEGER NOT NULL,
+                voter_count INTEGER NOT NULL,
+                PRIMARY KEY (poll_id, option_id)
+            );
+            CREATE TABLE IF NOT EXISTS vote_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                poll_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                option_ids TEXT NOT NULL,
+                recorded_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS vote_log_poll ON vote_log (poll_id, id);
+            CREATE TABLE IF NOT EXISTS final_results (
+                poll_id TEXT PRIMARY KEY,
+                closed_at REAL NOT NULL,
+                total_voter_count INTEGER NOT NULL,
+                counts TEXT NOT NULL,
+                local_counts TEXT NOT NULL,
+                choices TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS closed_polls (
+                poll_id TEXT PRIMARY KEY,
+                poll TEXT NOT NULL,
+                saved_at REAL NOT NULL
+            );
+        """)
+        # Stores created before the update id was kept
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(votes)")}
+        for column, column_type in (("update_id", "INTEGER"), ("previous_option_ids", "TEXT")):
+            if column not in columns:
+                try:
+                    conn.execute("ALTER TABLE votes ADD COLUMN {} {}".format(column, column_type))
+                except sqlite3.OperationalError:
+                    # Added by another thread in the meantime
+                    pass
+        _local.conn = conn
+    return conn
+
+
+def record_vote(poll_id, user, option_ids, update_id=None):
+    # Returns the options the user had before this answer (None when the store
+    # never saw the user in this poll) and the version of the new vote row.
+    # Recording the same update again (a retry) changes nothing and returns the same.
+    conn = _connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT option_ids, version, update_id, previous_option_ids FROM votes WHERE poll_id = ? AND user_id = ?", (poll_id, user["id"])).fetchone()
+        if row is not None and update_id is not None and row[2] == update_id and json.loads(row[0]) == option_ids:
+            conn.execute("COMMIT")
+            return (json.loads(row[3]) if row[3] is not None else None), row[1]
+        previous = json.loads(row[0]) if row is not None else None
+        version = row[1] + 1 if row is not None else 1
+
+        for option_id in previous or []:
+            conn.execute("UPDATE tallies SET voter_count = voter_count - 1 WHERE poll_id = ? AND option_id = ?", (poll_id, option_id))
+        for option_id in option_ids:
+            conn.execute(
+                "INSERT INTO tallies (poll_id, option_id, voter_count) VALUES (?, ?, 1) "
+                "ON CONFLICT (poll_id, option_id) DO UPDATE SET voter_count = voter_count + 1",
+                (poll_id, option_id)
+            )
+
+        conn.execute(
+            "INSERT INTO votes (poll_id, user_id, option_ids, user, version, updated_at, update_id, previous_option_ids) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (poll_id, user_id) DO UPDATE SET "
+            "option_ids = excluded.option_ids, user = excluded.user, version = excluded.version, updated_at = excluded.updated_at, "
+            "update_id = excluded.update_id, previous_option_ids = excluded.previous_option_ids",
+            (poll_id, user["id"], json.dumps(option_ids), json.dumps(user), version, now, update_id, json.dumps(previous) if previous is not None else None)
+        )
+        conn.execute("INSERT INTO vote_log (poll_id, user_id, option_ids, recorded_at) VALUES (?, ?, ?, ?)", (poll_id, user["id"], json.dumps(option_ids), now))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return previous, version
+
+
+def get_vote(poll_id, user_id):
+    row = _connection().execute("SELECT option_ids FROM votes WHERE poll_id = ? AND user_id = ?", (poll_id, user_id)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def get_tallies(poll_id):
+    rows = _connection().execute("SELECT option_id, voter_count FROM tallies WHERE poll_id = ? ORDER BY option_id", (poll_id,)).fetchall()
+    return {option_id: voter_count for option_id, voter_count in rows}
+
+
+def mark_synced(poll_id, user_id, version):
+    _connection().execute(
+        "UPDATE votes SET synced_version = ? WHERE poll_id = ? AND user_id = ? AND synced_version < ?",
+        (version, poll_id, user_id, version)
+    )
+
+
+def unsynced_votes():
+    rows = _connection().execute("SELECT poll_id, option_ids, user, version FROM votes WHERE synced_version < version ORDER BY updated_at").fetchall()
+    return [(poll_id, json.loads(user), json.loads(option_ids), version) for poll_id, option_ids, user, version in rows]
+
+
+def last_log_id():
+    return _connection().execute("SELECT COALESCE(MAX(id), 0) FROM vote_log").fetchone()[0]
+
+
+def read_vote_log(changed_since=0, until_id=None):
+    # With changed_since, the full history of only the polls that got answers after that log id
+    query = "SELECT id, poll_id, user_id, option_ids, recorded_at FROM vote_log WHERE id <= ?"
+    params = [until_id if until_id is not None else last_log_id()]
+    if changed_since:
+        query += " AND poll_id IN (SELECT DISTINCT poll_id FROM vote_log WHERE id > ? AND id <= ?)"
+        params += [changed_since, params[0]]
+    return _connection().execute(query + " ORDER BY id", params)
+
+
+def poll_votes(poll_id):
+    rows = _connection().execute("SELECT user_id, option_ids, user, version, synced_version FROM votes WHERE poll_id = ?", (poll_id,)).fetchall()
+    return [(user_id, json.loads(option_ids), json.loads(user), version, synced_version) for user_id, option_ids, user, version, synced_version in rows]
+
+
+def save_closed_poll(poll):
+    # The last poll telegram sent once it was closed, its counts are final
+    _connection().execute(
+        "INSERT OR REPLACE INTO closed_polls (poll_id, poll, saved_at) VALUES (?, ?, ?)",
+        (poll["id"], json.dumps(poll), time.time())
+    )
+
+
+def get_closed_poll(poll_id):
+    row = _connection().execute("SELECT poll FROM closed_polls WHERE poll_id = ?", (poll_id,)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def save_final_result(poll_id, total_voter_count, counts, local_counts, choices):
+    # counts are telegram's final voter counts per option, local_counts the ones
+    # from the votes recorded here and choices user id -> option ids
+    _connection().execute(
+        "INSERT OR REPLACE INTO final_results (poll_id, closed_at, total_voter_count, counts, local_counts, choices) VALUES (?, ?, ?, ?, ?, ?)",
+        (poll_id, time.time(), total_voter_count, json.dumps(counts), json.dumps(local_counts), json.dumps(choices))
+    )
+
+
+def _final_result(row):
+    poll_id, closed_at, total_voter_count, counts, local_counts, choices = row
+    return {
+        "poll_id": poll_id,
+        "closed_at": closed_at,
+        "total_voter_count": total_voter_count,
+        "counts": json.loads(counts),
+        "local_counts": json.loads(local_counts),
+        "choices": {int(user_id): option_ids for user_id, option_ids in json.loads(choices).items()},
+    }
+
+
+def get_final_result(poll_id):
+    row = _connection().execute("SELECT poll_id, closed_at, total_voter_count, counts, local_counts, choices FROM final_results WHERE poll_id = ?", (poll_id,)).fetchone()
+    return _final_result(row) if row is not None else None
+
+
+def final_results():
+    rows = _connection().execute("SELECT poll_id, closed_at, total_voter_count, counts, local_counts, choices FROM final_results ORDER BY closed_at")
+    return [_final_result(row) for row in rows]
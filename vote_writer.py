@@ -0,0 +1,179 @@
+import os
+import atexit
+import logging
+import threading
+import log_setup
+import metrics
+import http_client
+import page_cache
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+batch_interval = float(os.getenv("VOTE_BATCH_INTERVAL", "1"))
+# More writers than the notion rate limit lets through would only queue on the limiter
+max_concurrency = int(os.getenv("VOTE_WRITE_CONCURRENCY", str(max(1, http_client.notion_burst))))
+max_write_attempts = int(os.getenv("VOTE_WRITE_ATTEMPTS", "5"))
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_stop = threading.Event()
+# (poll_id, user_id) -> {"insert": properties of the vote to create, "archive": existing page must go}
+_pending = {}
+_flusher = None
+_executor = None
+_database_id = None
+_lookup_page_id = None
+_on_synced = None
+
+
+def start(database_id, lookup_page_id, on_synced=None):
+    global _flusher, _executor, _database_id, _lookup_page_id, _on_synced
+    with _lock:
+        if _flusher is not None:
+            return
+        _database_id, _lookup_page_id, _on_synced = database_id, lookup_page_id, on_synced
+        _executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="vote-writer")
+        _stop.clear()
+        _flusher = threading.Thread(target=_run, name="vote-writer-flusher", daemon=True)
+        _flusher.start()
+    atexit.register(flush_all)
+    logging.info("Started the vote writer with a batch interval of %s seconds and %s concurrent writes.", batch_interval, max_concurrency)
+
+
+def stop():
+    global _flusher
+    _stop.set()
+    if _flusher is not None:
+        _flusher.join()
+        _flusher = None
+    flush_all()
+
+
+def _state(poll_id, user_id, version):
+    state = _pending.setdefault((poll_id, user_id), {"insert": None, "archive": False, "attempts": 0, "version": None})
+    state["version"] = version if version is not None else state["version"]
+    return state
+
+
+def submit_vote(poll_id, user_id, properties, version=None, replace_existing=False):
+    with _lock:
+        state = _state(poll_id, user_id, version)
+        # A re-vote replaces the row that is still waiting to be written
+        state["insert"] = properties
+        state["archive"] = state["archive"] or replace_existing
+
+
+def submit_retraction(poll_id, user_id, version=None):
+    with _lock:
+        state = _state(poll_id, user_id, version)
+        if state["insert"] is not None:
+            # The vote never reached notion, so the two cancel out
+            state["insert"] = None
+        else:
+            state["archive"] = True
+        if state["insert"] is None and not state["archive"]:
+            del _pending[(poll_id, user_id)]
+            if _on_synced is not None and state["version"] is not None:
+                _on_synced(poll_id, user_id, state["version"])
+
+
+def pending_count():
+    with _lock:
+        return len(_pending)
+
+
+def _create(poll_id, user_id, properties):
+    payload = {"parent": {"database_id": _database_id}, "properties": properties}
+    response = http_client.notion_request("POST", "/pages", json=payload)
+    response_json = response.json()
+    logging.info("Response from insert user vote api call - %s", log_setup.payload(response_json))
+    if response.status_code != 200:
+        return False
+    page_cache.set_vote_page(poll_id, user_id, response_json["id"])
+    return True
+
+
+def _write(key, state):
+    with metrics.stage("notion_write"):
+        return _write_state(key, state)
+
+
+def _write_state(key, state):
+    poll_id, user_id = key
+    try:
+        page_id = _lookup_page_id(poll_id, user_id) if state["archive"] else None
+
+        if state["archive"] and page_id is None:
+            logging.error("Not able to find the vote entry of user %s for poll %s. Skipping the archive.", user_id, poll_id)
+
+        if page_id is not None and state["insert"] is not None:
+            # Re-vote, rewrite the existing row instead of archiving it and creating another
+            response = http_client.notion_request("PATCH", "/pages/{}".format(page_id), json={"properties": state["insert"]})
+            logging.info("Response from update user vote api call - %s", log_setup.payload(response.json))
+            return response.status_code == 200
+
+        if page_id is not None:
+            response = http_client.notion_request("PATCH", "/pages/{}".format(page_id), json={"archived": True})
+            logging.info("Response from remove user entry api call since user has retracted the vote - %s", log_setup.payload(response.json))
+            if response.status_code != 200:
+                return False
+            page_cache.remove_vote_page(poll_id, user_id)
+            state["archive"] = False
+
+        if state["insert"] is not None:
+            return _create(poll_id, user_id, state["insert"])
+        return True
+    except Exception as e:
+        logging.error("Unable to write the vote of user %s for poll %s. Error - %s", user_id, poll_id, e)
+        return False
+
+
+def _requeue(key, state):
+    if state["attempts"] + 1 >= max_write_attempts:
+        logging.error("Giving up on the vote of user %s for poll %s after %s attempts.", key[1], key[0], state["attempts"] + 1)
+        return
+    with _lock:
+        newer = _pending.get(key)
+        if newer is None:
+            state["attempts"] += 1
+            _pending[key] = state
+        else:
+            # Newer changes win, but an archive that did not go through is still owed
+            newer["archive"] = newer["archive"] or state["archive"]
+
+
+def _synced(key, state):
+    if _on_synced is None or state["version"] is None:
+        return
+    try:
+        _on_synced(key[0], key[1], state["version"])
+    except Exception as e:
+        logging.error("Unable to mark the vote of user %s for poll %s as synced. Error - %s", key[1], key[0], e)
+
+
+def flush_all():
+    with _flush_lock:
+        with _lock:
+            batch = list(_pending.items())
+            _pending.clear()
+        if not batch:
+            return
+
+        logging.info("Writing a batch of %s votes to notion.", len(batch))
+        if _executor is None:
+            results = [_write(key, state) for key, state in batch]
+        else:
+            results = list(_executor.map(lambda item: _write(*item), batch))
+
+        for (key, state), written in zip(batch, results):
+            if written:
+                _synced(key, state)
+            else:
+                _requeue(key, state)
+
+
+def _run():
+    while not _stop.wait(batch_interval):
+        flush_all()